@@ -0,0 +1,118 @@
+import collections
+import numpy as np
+
+
+class Vocabulary:
+    """maps values (e.g. hashtags) to dense integer ids, in the order values are first seen"""
+
+    def __init__(self, values=()):
+        self.values = []
+        self._ids = {}
+        for value in values:
+            self.id(value)
+
+    def id(self, value):
+        i = self._ids.get(value)
+        if i is None:
+            i = self._ids[value] = len(self.values)
+            self.values.append(value)
+        return i
+
+    def __len__(self):
+        return len(self.values)
+
+
+class Counts:
+    """sparse counts of (bucket, id) pairs, kept as columns of unique pairs
+    sorted by bucket, then id
+
+    counts of the same pair are summed, therefore counts of disjoint sets of
+    (e.g. per day, per query) can be merged with `add`.
+    """
+
+    def __init__(self, buckets=(), ids=(), counts=None):
+        self.buckets = np.empty(0, dtype=np.int64)
+        self.ids = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.add(buckets, ids, counts)
+
+    def add(self, buckets, ids, counts=None):
+        """count `ids[j]` in `buckets[j]`, `counts[j]` times (default: once)"""
+        buckets = np.asarray(buckets, dtype=np.int64)
+        ids = np.asarray(ids, dtype=np.int64)
+        if counts is None:
+            counts = np.ones(len(ids), dtype=np.int64)
+        counts = np.asarray(counts, dtype=np.int64)
+        if not len(ids):
+            return
+
+        pairs, inverse = np.unique(
+            np.stack([np.r_[self.buckets, buckets], np.r_[self.ids, ids]]),
+            axis=1,
+            return_inverse=True,
+        )
+        self.buckets, self.ids = pairs
+        self.counts = np.bincount(
+            inverse.reshape(-1),
+            weights=np.r_[self.counts, counts],
+            minlength=pairs.shape[1],
+        ).astype(np.int64)
+
+    def without(self, bucket):
+        """counts of every bucket except `bucket`"""
+        keep = self.buckets != bucket
+        return Counts(self.buckets[keep], self.ids[keep], self.counts[keep])
+
+    def rebucketed(self, size):
+        """counts with every `size` consecutive buckets merged into one (e.g. hours into days)"""
+        return Counts(self.buckets // size, self.ids, self.counts)
+
+    def totals(self, n_ids):
+        """total count of every id, over every bucket"""
+        return np.bincount(self.ids, weights=self.counts, minlength=n_ids).astype(
+            np.int64
+        )
+
+    def state(self):
+        return {
+            "buckets": self.buckets.tolist(),
+            "ids": self.ids.tolist(),
+            "counts": self.counts.tolist(),
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(state["buckets"], state["ids"], state["counts"])
+
+
+def ranked(counts, vocabulary, k=None):
+    """{value: count} of `counts` (count per id), most common first (ties in the order first seen),
+    only the `k` most common if given"""
+    # stable sort keeps ids (first seen order) of the same count in order
+    order = np.argsort(-counts, kind="stable")
+    order = order[counts[order] > 0][:k]
+    return collections.OrderedDict(
+        (vocabulary.values[i], int(c)) for i, c in zip(order, counts[order])
+    )
+
+
+def ranked_per_bucket(buckets, ids, counts, n_buckets, vocabulary, k=None):
+    """`ranked` of every bucket, where `buckets[j]` (0 <= bucket < n_buckets) is the bucket
+    of the unique pair (`buckets[j]`, `ids[j]`) counted `counts[j]` times.
+    computed in a single pass over every pair rather than per bucket"""
+    # by bucket, then most common first, then first seen first
+    order = np.lexsort((ids, -counts, buckets))
+    buckets, ids, counts = buckets[order], ids[order], counts[order]
+
+    # rank of each pair within its bucket
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    lengths = np.diff(np.r_[starts, len(buckets)])
+    ranks = np.arange(len(buckets)) - np.repeat(starts, lengths)
+    if k is not None:
+        keep = ranks < k
+        buckets, ids, counts = buckets[keep], ids[keep], counts[keep]
+
+    result = [collections.OrderedDict() for _ in range(n_buckets)]
+    for b, i, c in zip(buckets.tolist(), ids.tolist(), counts.tolist()):
+        result[b][vocabulary.values[i]] = c
+    return result
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import pathlib
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+_lock = threading.Lock()
+_caches = {}
+
+# sqlite limits the number of variables per statement
+_MAX_VARIABLES = 500
+
+
+def normalize(text):
+    """text with unicode normalized and whitespaces collapsed,
+    so that formatting-only differences share a cache entry"""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+
+class AnalysisCache:
+    """persistent cache of analysis results, stored in a sqlite database
+
+    results are keyed by a hash of the analysed text, the analyser's version and parameters
+    (see `key`), and stored as JSON.
+    least recently used results are evicted once the cache exceeds `max_entries` results.
+    """
+
+    def __init__(self, path, max_entries):
+        self.path = pathlib.Path(path)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, used REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS results_used ON results (used)"
+            )
+        (self._size,) = self._db.execute("SELECT COUNT(*) FROM results").fetchone()
+
+    @staticmethod
+    def key(version, params, text):
+        h = hashlib.sha256()
+        h.update(f"{version}\n{json.dumps(params, sort_keys=True)}\n".encode("utf-8"))
+        h.update(normalize(text).encode("utf-8"))
+        return h.hexdigest()
+
+    def get_many(self, keys):
+        """{key: result} of every cached key in `keys`"""
+        keys = list(set(keys))
+        found = {}
+        with self._lock, self._db:
+            for i in range(0, len(keys), _MAX_VARIABLES):
+                chunk = keys[i : i + _MAX_VARIABLES]
+                marks = ",".join("?" * len(chunk))
+                rows = self._db.execute(
+                    f"SELECT key, value FROM results WHERE key IN ({marks})", chunk
+                ).fetchall()
+                self._db.execute(
+                    f"UPDATE results SET used = ? WHERE key IN ({marks})",
+                    [time.time(), *chunk],
+                )
+                found.update((key, json.loads(value)) for key, value in rows)
+        return found
+
+    def put_many(self, results):
+        """store {key: result} of `results`"""
+        if not results:
+            return
+
+        now = time.time()
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO results (key, value, used) VALUES (?, ?, ?)",
+                [
+                    (key, json.dumps(value, ensure_ascii=False), now)
+                    for key, value in results.items()
+                ],
+            )
+            (self._size,) = self._db.execute("SELECT COUNT(*) FROM results").fetchone()
+
+            if self._size > self.max_entries:
+                # evict a tenth more than needed, not to evict on every put
+                evicted = self._size - self.max_entries + self.max_entries // 10
+                self._db.execute(
+                    "DELETE FROM results WHERE key IN "
+                    "(SELECT key FROM results ORDER BY used LIMIT ?)",
+                    (evicted,),
+                )
+                self._size -= evicted
+
+
+def load(path, max_entries):
+    """analysis cache stored at `path`, shared by every analyser in the process"""
+    path = pathlib.Path(path)
+    with _lock:
+        key = str(path.resolve())
+        if key not in _caches:
+            _caches[key] = AnalysisCache(path, max_entries)
+        return _caches[key]
@@ -0,0 +1,274 @@
+"""offline micro-benchmarks of the post parsers (`_parse_post` of each crawler)
+
+post pages and comment api responses are served from the checked-in fixtures (fixtures/)
+instead of the network, so that only parsing is measured.
+latency per call and peak memory allocated by Python objects during a call are reported,
+and compared with the stored baseline (baseline.json).
+
+    python benchmarks/bench_parse.py            # compare with the baseline
+    python benchmarks/bench_parse.py --save     # store the results as the new baseline
+
+exits with status 1 if a case got slower (by the fastest run) (or allocates more) than `--threshold` of the baseline.
+baselines are machine dependent, store one per machine before comparing.
+"""
+
+import argparse
+import gc
+import json
+import pathlib
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = pathlib.Path(__file__).resolve().parent
+sys.path.insert(0, str(ROOT.parent))
+
+from lxml import etree
+import config
+
+# crawlers below do not create the analysis cache
+config.ANALYSIS_CACHE = None
+
+import naver_blog
+import naver_cafe
+import tistory
+
+FIXTURES = ROOT / "fixtures"
+BASELINE = ROOT / "baseline.json"
+
+
+class FixtureResponse:
+    status_code = 200
+    ok = True
+
+    def __init__(self, url, text):
+        self.url = url
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class FixtureSession:
+    """serves fixtures instead of requesting,
+    `routes` maps url substrings to fixture paths (checked in order)"""
+
+    def __init__(self, routes):
+        self._routes = [
+            (pattern, (FIXTURES / path).read_text(encoding="utf-8"))
+            for pattern, path in routes.items()
+        ]
+
+    def request(self, method, url, **kwargs):
+        for pattern, text in self._routes:
+            if pattern in url:
+                return FixtureResponse(url, text)
+        raise ValueError(f"No fixture for {method} {url}")
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+
+def naver_blog_case(page):
+    def setup():
+        session = FixtureSession(
+            {
+                "PostView.nhn": f"naver_blog/{page}",
+                "commentBox": "naver_blog/commentBox.jsonp",
+            }
+        )
+        crawler = naver_blog.NaverBlog(
+            id="", secret="", session=session, analysis_processes=0
+        )
+        return lambda: crawler._parse_post("thornapple", "221234567890")
+
+    return setup
+
+
+def naver_cafe_case():
+    def setup():
+        session = FixtureSession(
+            {
+                "ArticleRead.nhn": "naver_cafe/ArticleRead.html",
+                "CommentView.nhn": "naver_cafe/CommentView.json",
+                "cafe.naver.com/thornapple/": "naver_cafe/redirect.html",
+            }
+        )
+        # clubid learnt from the redirect page is not written to the user's mapping
+        naver_cafe.club_ids = naver_cafe.ClubIds(
+            pathlib.Path(tempfile.mkdtemp()) / "club_ids.json"
+        )
+        crawler = naver_cafe.NaverCafe(id="", secret="", session=session)
+        return lambda: crawler._parse_post("http://cafe.naver.com/thornapple/13787")
+
+    return setup
+
+
+def tistory_case(theme):
+    def setup():
+        session = FixtureSession({"tistory.com": f"tistory/{theme}.html"})
+        crawler = tistory.Tistory(key="", session=session)
+        return lambda: crawler._parse_post("https://thornapple.tistory.com/29")
+
+    return setup
+
+
+CASES = {
+    "naver_blog/se3": naver_blog_case("PostView_se3.html"),
+    "naver_blog/se2": naver_blog_case("PostView_se2.html"),
+    "naver_blog/legacy": naver_blog_case("PostView_legacy.html"),
+    "naver_cafe/article": naver_cafe_case(),
+    # themes listed in tistory.POST_SPEC
+    **{
+        f"tistory/{theme}": tistory_case(theme)
+        for theme in (
+            "tt_article_useless_p_margin",
+            "article_view",
+            "entry-content",
+            "post-content",
+            "desc",
+            "article_cont",
+            "article",
+            "area_view",
+        )
+    },
+}
+
+
+def measure(func, repeat, number):
+    """median and min seconds per call over `repeat` runs of `number` calls,
+    and peak bytes allocated during a call"""
+    # warm up, not to time caches being filled
+    for _ in range(number):
+        func()
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number)
+
+    # memory allocated by libxml2 itself is not traced
+    gc.collect()
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "median_us": round(statistics.median(timings) * 1e6, 1),
+        "min_us": round(min(timings) * 1e6, 1),
+        "peak_kib": round((peak - before) / 1024, 1),
+    }
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "lxml": ".".join(str(v) for v in etree.LXML_VERSION),
+        "libxml2": ".".join(str(v) for v in etree.LIBXML_VERSION),
+        "machine": platform.machine(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark post parsers offline")
+    parser.add_argument("-k", "--filter", help="Run cases containing this string")
+    parser.add_argument(
+        "--repeat", type=int, default=10, help="Number of timed runs per case"
+    )
+    parser.add_argument(
+        "--number", type=int, default=20, help="Number of calls per timed run"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="Relative slowdown (or allocation growth) reported as a regression",
+    )
+    parser.add_argument("--baseline", default=str(BASELINE), help="Baseline file")
+    parser.add_argument(
+        "--save", action="store_true", help="Store results as the new baseline"
+    )
+    args = parser.parse_args()
+
+    baseline = {}
+    baseline_path = pathlib.Path(args.baseline)
+    if baseline_path.exists() and not args.save:
+        with open(str(baseline_path), "r", encoding="utf-8") as f:
+            baseline = json.loads(f.read())
+        if baseline.get("environment") != environment():
+            print(
+                f"[!] Baseline measured on {baseline.get('environment')}, "
+                f"now {environment()}"
+            )
+
+    results = {}
+    regressions = []
+    print(
+        f"{'case':<40} {'median us':>10} {'min us':>10} {'peak KiB':>9} {'base min':>10} {'change':>8}"
+    )
+    for name, setup in CASES.items():
+        if args.filter and args.filter not in name:
+            continue
+
+        func = setup()
+        # make sure the fixture still parses
+        post = func()
+        if not post.get("text"):
+            raise ValueError(f"{name}: text not parsed")
+
+        result = results[name] = measure(func, args.repeat, args.number)
+
+        previous = baseline.get("cases", {}).get(name)
+        change = ""
+        if previous is not None:
+            # min is the least disturbed by other processes
+            ratio = result["min_us"] / previous["min_us"] - 1
+            change = f"{ratio:+.1%}"
+            if ratio > args.threshold:
+                regressions.append(f"{name}: {change} time")
+            if result["peak_kib"] > previous["peak_kib"] * (1 + args.threshold):
+                regressions.append(
+                    f"{name}: {previous['peak_kib']:.1f} -> {result['peak_kib']:.1f} KiB"
+                )
+
+        print(
+            f"{name:<40} {result['median_us']:>10.1f} {result['min_us']:>10.1f} "
+            f"{result['peak_kib']:>9.1f} "
+            f"{previous['min_us'] if previous else float('nan'):>10.1f} {change:>8}"
+        )
+
+    if args.save:
+        with open(str(baseline_path), "w", encoding="utf-8") as f:
+            f.write(
+                json.dumps(
+                    {"environment": environment(), "cases": results},
+                    indent=2,
+                    sort_keys=True,
+                )
+            )
+        print(f"Baseline saved to {baseline_path}")
+        return
+
+    if regressions:
+        print("Regressions:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+
+    main()
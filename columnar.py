@@ -0,0 +1,386 @@
+"""columnar, memory-mappable dataset layout
+
+a dataset is a directory holding `meta.json` and raw little-endian arrays per column,
+so that columns can be read one at a time with np.memmap instead of loading every post:
+
+    meta.json                  {"version": 1, "count": <posts>, "columns": {<name>: <kind>}}
+
+kinds of columns and their files:
+
+    datetime   <name>.values       int64 seconds since 1970-01-01 utc (NaT for missing dates)
+    int        <name>.values       int64 (NULL_INT for missing values)
+    string     <name>.offsets      int64 * (count + 1), post i is data[offsets[i]:offsets[i + 1]]
+               <name>.data         utf-8 bytes (missing values are empty strings)
+    json       (same as string)    JSON encoded values, e.g. nested comments
+    dict       <name>.codes        int32 index into the dictionary (-1 for missing values)
+               <name>.dictionary.json   JSON list of distinct values
+    dict_list  <name>.offsets      int64 * (count + 1), codes of post i are codes[offsets[i]:offsets[i + 1]]
+               <name>.codes        int32 index into the dictionary
+               <name>.dictionary.json   JSON list of distinct values
+"""
+
+from datetime import datetime, timezone
+import json
+import pathlib
+import numpy as np
+
+VERSION = 1
+
+# columns of strings repeated across posts, stored as codes into a dictionary
+DICTIONARY_COLUMNS = ("username", "nickname", "blogname", "cafename")
+# columns of lists of strings repeated across posts
+DICTIONARY_LIST_COLUMNS = ("hashtags",)
+
+NULL_INT = np.iinfo(np.int64).min
+
+
+def _kind(name, value):
+    if name == "created":
+        return "datetime"
+    if name in DICTIONARY_COLUMNS:
+        return "dict"
+    if name in DICTIONARY_LIST_COLUMNS:
+        return "dict_list"
+    if isinstance(value, int) and not isinstance(value, bool):
+        return "int"
+    if isinstance(value, str):
+        return "string"
+    return "json"
+
+
+def _utc(value):
+    """naive utc datetime of an ISO 8601 string, e.g. Tistory's `2020-02-05T14:31:00+09:00`.
+    datetimes without offset are kept as they are"""
+    created = datetime.fromisoformat(value)
+    if created.tzinfo is not None:
+        created = created.astimezone(timezone.utc).replace(tzinfo=None)
+    return created
+
+
+def _last_int64(path):
+    with open(str(path), "rb") as f:
+        f.seek(-8, 2)
+        return int(np.frombuffer(f.read(8), dtype="<i8")[0])
+
+
+def _truncate(path, size):
+    """cut `path` to `size` bytes, i.e. drop what an interrupted append wrote
+    after the dataset was last closed"""
+    with open(str(path), "r+b") as f:
+        f.truncate(size)
+
+
+# writers of a column take `count`, the number of posts already saved when appending
+# (None for a new column), and open its files positioned after those posts
+
+
+class _Values:
+    """datetime and int columns"""
+
+    def __init__(self, directory, name, kind, count):
+        self.kind = kind
+        values = directory / f"{name}.values"
+        if count is not None:
+            _truncate(values, count * 8)
+        self._f = open(str(values), "wb" if count is None else "ab")
+
+    def write(self, value):
+        if value is None or value == "":
+            value = NULL_INT
+        elif self.kind == "datetime":
+            value = np.datetime64(_utc(value), "s").astype(np.int64)
+        self._f.write(np.array([value], dtype="<i8").tobytes())
+
+    def close(self):
+        self._f.close()
+
+
+class _Strings:
+    """string and json columns"""
+
+    def __init__(self, directory, name, kind, count):
+        self.kind = kind
+        offsets = directory / f"{name}.offsets"
+        data = directory / f"{name}.data"
+        if count is not None:
+            _truncate(offsets, (count + 1) * 8)
+            self._end = _last_int64(offsets)
+            _truncate(data, self._end)
+            self._offsets = open(str(offsets), "ab")
+        else:
+            self._end = 0
+            self._offsets = open(str(offsets), "wb")
+            self._offsets.write(np.array([0], dtype="<i8").tobytes())
+        self._data = open(str(data), "wb" if count is None else "ab")
+
+    def write(self, value):
+        if self.kind == "json":
+            value = json.dumps(value, ensure_ascii=False)
+        data = (value or "").encode("utf-8")
+        self._data.write(data)
+        self._end += len(data)
+        self._offsets.write(np.array([self._end], dtype="<i8").tobytes())
+
+    def close(self):
+        self._offsets.close()
+        self._data.close()
+
+
+class _Dictionary:
+    """dict and dict_list columns"""
+
+    def __init__(self, directory, name, kind, count):
+        self.kind = kind
+        self._dictionary_path = directory / f"{name}.dictionary.json"
+        self._values = []
+        if count is not None:
+            with open(str(self._dictionary_path), "r", encoding="utf-8") as f:
+                self._values = json.loads(f.read())
+        self._ids = {value: i for i, value in enumerate(self._values)}
+
+        codes = directory / f"{name}.codes"
+        if kind == "dict_list":
+            offsets = directory / f"{name}.offsets"
+            if count is not None:
+                _truncate(offsets, (count + 1) * 8)
+                self._end = _last_int64(offsets)
+                self._offsets = open(str(offsets), "ab")
+            else:
+                self._end = 0
+                self._offsets = open(str(offsets), "wb")
+                self._offsets.write(np.array([0], dtype="<i8").tobytes())
+        if count is not None:
+            _truncate(codes, (self._end if kind == "dict_list" else count) * 4)
+        self._codes = open(str(codes), "wb" if count is None else "ab")
+
+    def _code(self, value):
+        i = self._ids.get(value)
+        if i is None:
+            i = self._ids[value] = len(self._values)
+            self._values.append(value)
+        return i
+
+    def write(self, value):
+        if self.kind == "dict":
+            codes = [-1 if value is None else self._code(value)]
+        else:
+            codes = [self._code(v) for v in value or []]
+            self._end += len(codes)
+            self._offsets.write(np.array([self._end], dtype="<i8").tobytes())
+        self._codes.write(np.array(codes, dtype="<i4").tobytes())
+
+    def close(self):
+        self._codes.close()
+        if self.kind == "dict_list":
+            self._offsets.close()
+        with open(str(self._dictionary_path), "w", encoding="utf-8") as f:
+            f.write(json.dumps(self._values, ensure_ascii=False))
+
+
+_WRITERS = {
+    "datetime": _Values,
+    "int": _Values,
+    "string": _Strings,
+    "json": _Strings,
+    "dict": _Dictionary,
+    "dict_list": _Dictionary,
+}
+
+
+class ColumnarSink:
+    """writes posts as a columnar dataset directory (see the layout above),
+    columns are appended post by post, so that memory stays flat
+
+    columns missing in some posts are stored as missing values,
+    if `append` is set, posts are added to the existing dataset.
+    `meta.json` is written on close, posts written by a run interrupted before
+    (beyond the count of meta.json) are dropped when appending.
+    """
+
+    def __init__(self, path, append=False):
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._count = 0
+        self._kinds = {}
+        self._writers = {}
+        self._sizes = {}
+
+        meta = self.path / "meta.json"
+        if append and meta.exists():
+            with open(str(meta), "r", encoding="utf-8") as f:
+                meta = json.loads(f.read())
+            self._count = meta["count"]
+            for name, kind in meta["columns"].items():
+                self._open(name, kind, self._count)
+        elif meta.exists():
+            # not to describe the columns being overwritten
+            meta.unlink()
+
+    def _open(self, name, kind, count=None):
+        self._kinds[name] = kind
+        self._writers[name] = _WRITERS[kind](self.path, name, kind, count)
+        self._sizes[name] = count or 0
+
+    def _pad(self, name, size):
+        while self._sizes[name] < size:
+            self._writers[name].write(None)
+            self._sizes[name] += 1
+
+    def write(self, post):
+        for name, value in post.items():
+            if name not in self._writers:
+                self._open(name, _kind(name, value))
+            # column first seen in this post
+            self._pad(name, self._count)
+            self._writers[name].write(value)
+            self._sizes[name] += 1
+        self._count += 1
+
+    def close(self):
+        for name, writer in self._writers.items():
+            self._pad(name, self._count)
+            writer.close()
+
+        meta = {"version": VERSION, "count": self._count, "columns": self._kinds}
+        with open(str(self.path / "meta.json"), "w", encoding="utf-8") as f:
+            f.write(json.dumps(meta, indent=2))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _map(path, dtype):
+    # empty files can not be memory-mapped
+    if path.stat().st_size == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(str(path), dtype=dtype, mode="r")
+
+
+class Strings:
+    """string (or json) column, values are decoded when accessed"""
+
+    def __init__(self, offsets, data, decode=None):
+        self.offsets = offsets
+        self.data = data
+        self._decode = decode
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        value = bytes(self.data[self.offsets[i] : self.offsets[i + 1]]).decode("utf-8")
+        return self._decode(value) if self._decode is not None else value
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class Dictionary:
+    """dictionary encoded column: `values[codes[i]]` is the value of post i"""
+
+    def __init__(self, codes, values):
+        self.codes = codes
+        self.values = values
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        code = self.codes[i]
+        return None if code < 0 else self.values[code]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class DictionaryLists:
+    """dictionary encoded list column:
+    `values[c] for c in codes[offsets[i]:offsets[i + 1]]` are the values of post i"""
+
+    def __init__(self, offsets, codes, values):
+        self.offsets = offsets
+        self.codes = codes
+        self.values = values
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        codes = self.codes[self.offsets[i] : self.offsets[i + 1]]
+        return [self.values[c] for c in codes]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class Dataset:
+    """columnar dataset directory written by ColumnarSink, columns are memory-mapped on access"""
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        with open(str(self.path / "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.loads(f.read())
+        if meta["version"] != VERSION:
+            raise ValueError(f"Unsupported columnar dataset version: {meta['version']}")
+        self.count = meta["count"]
+        self.kinds = meta["columns"]
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def columns(self):
+        return list(self.kinds.keys())
+
+    def _dictionary(self, name):
+        with open(
+            str(self.path / f"{name}.dictionary.json"), "r", encoding="utf-8"
+        ) as f:
+            return json.loads(f.read())
+
+    def column(self, name):
+        """datetime64 / int64 array, or Strings / Dictionary / DictionaryLists of the column"""
+        kind = self.kinds[name]
+        if kind == "datetime":
+            return _map(self.path / f"{name}.values", "<i8").view("datetime64[s]")
+        if kind == "int":
+            return _map(self.path / f"{name}.values", "<i8")
+        if kind in ("string", "json"):
+            return Strings(
+                _map(self.path / f"{name}.offsets", "<i8"),
+                _map(self.path / f"{name}.data", np.uint8),
+                json.loads if kind == "json" else None,
+            )
+        if kind == "dict":
+            return Dictionary(
+                _map(self.path / f"{name}.codes", "<i4"), self._dictionary(name)
+            )
+        return DictionaryLists(
+            _map(self.path / f"{name}.offsets", "<i8"),
+            _map(self.path / f"{name}.codes", "<i4"),
+            self._dictionary(name),
+        )
+
+    def rows(self, columns=None):
+        """yields posts as dicts (of `columns`, default: every column)"""
+        columns = {name: self.column(name) for name in columns or self.columns}
+        for i in range(self.count):
+            post = {}
+            for name, column in columns.items():
+                value = column[i]
+                if self.kinds[name] == "datetime":
+                    value = None if np.isnat(value) else str(value)
+                elif self.kinds[name] == "int":
+                    value = None if value == NULL_INT else int(value)
+                post[name] = value
+            yield post
+
+
+def load(path):
+    return Dataset(path)
@@ -33,6 +33,75 @@ except:
     # for global logging, after this codes being packaged, no more needed
     LOGGER_NAME = "bellorin"
 
-    # seconds to sleep between each requests (per target)
-    REQUEST_INTERVAL = 0.5
+    # request rate limits shared by every crawler in the process, per host
+    # host pattern: (requests per second, burst size)
+    RATE_LIMITS = {
+        "openapi.naver.com": (5, 5),
+        "blog.naver.com": (2, 4),
+        "cafe.naver.com": (2, 4),
+        "apis.naver.com": (2, 4),
+        "dapi.kakao.com": (5, 5),
+        "*.tistory.com": (2, 4),
+    }
+    # limit for hosts not listed above (None for no limit)
+    DEFAULT_RATE_LIMIT = (2, 4)
 
+    # pooled keep-alive connections of the shared http session
+    # number of hosts to keep connection pools for
+    HTTP_POOL_CONNECTIONS = 16
+    # connections kept open per host (run.py sizes this to its concurrency)
+    HTTP_POOL_MAXSIZE = 10
+    # per host overrides of HTTP_POOL_MAXSIZE, e.g. {"blog.naver.com": 8}
+    HTTP_HOST_POOL_MAXSIZE = {}
+
+    # on-disk http response cache (enabled by `run.py --cache`)
+    HTTP_CACHE_DIR = ".cache/http"
+    # maximum size of the cache in bytes, least recently used responses are evicted
+    HTTP_CACHE_MAX_SIZE = 1024 * 1024 * 1024
+    # seconds a cached response is valid, per endpoint type
+    HTTP_CACHE_TTL = {
+        "search": 0,  # search results change constantly, stored only for offline replay
+        "post": 7 * 24 * 60 * 60,
+        "comment": 60 * 60,
+    }
+
+    # instagram login sessions, reused across runs (see instagram.shared_loader)
+    INSTAGRAM_SESSION_DIR = ".cache/instagram"
+
+    # number of posts written per transaction to the sqlite post store (`run.py -f sqlite`)
+    STORE_BATCH_SIZE = 100
+
+    # cafe name -> clubid mapping of naver cafes, saves a redirect request per cafe article
+    NAVER_CAFE_CLUB_IDS = ".cache/naver_cafe_clubids.json"
+
+    # maximum number of comments (including replies) collected per post
+    MAX_COMMENTS_PER_POST = 1000
+
+    # number of recently parsed posts kept to be shared between crawlers of different queries
+    POST_REGISTRY_MAX_POSTS = 10000
+
+    # number of search result pages fetched ahead of the posts being crawled
+    SEARCH_PREFETCH_PAGES = 1
+
+    # maximum number of posts fetched at the same time (per target)
+    NAVER_BLOG_MAX_IN_FLIGHT = 4
+    NAVER_CAFE_MAX_IN_FLIGHT = 4
+    TISTORY_MAX_IN_FLIGHT = 4
+    # maximum number of instagram posts collecting comments at the same time
+    INSTAGRAM_MAX_IN_FLIGHT = 4
+
+    # TextRank analysis of naver blog posts runs in a process pool
+    # number of worker processes (None for the number of cpus, 0 to analyse in the crawler thread)
+    ANALYSIS_PROCESSES = None
+    # number of posts submitted to a worker per task
+    ANALYSIS_CHUNK_SIZE = 8
+    # seconds allowed per post, a post taking longer is left without key sentences
+    ANALYSIS_TIMEOUT = 30
+    # number of crawled posts kept ahead of the analysis (crawling waits when it is full)
+    ANALYSIS_QUEUE_SIZE = 256
+    # cache of analysis results keyed by the hash of post texts (None to disable)
+    ANALYSIS_CACHE = ".cache/analysis.sqlite3"
+    # maximum number of cached results, least recently used results are evicted
+    ANALYSIS_CACHE_MAX_ENTRIES = 100000
+    # number of most common hashtags / users reported per day and hour of instagram posts
+    ANALYSIS_TOP_K = 10
@@ -1,7 +1,15 @@
 from abc import ABCMeta, abstractmethod
+import metrics
+
 
 # Crawler interface
 class Crawler(metaclass=ABCMeta):
+    # every column of a post, and the main columns emitted with `main_columns_only`
+    FIELDS = ()
+    MAIN_FIELDS = ()
+    # columns identifying a post of the platform
+    KEY_FIELDS = ()
+
     @abstractmethod
     def __init__(self, *args, **kwargs):
         pass
@@ -11,6 +19,11 @@ class Crawler(metaclass=ABCMeta):
         """crawl method should scrap data related to `query` with range [`start_date`, `end_date]"""
         pass
 
+    @abstractmethod
+    def iter_crawl(self, query, start_date, end_date, *args, **kwargs):
+        """iter_crawl method should yield the data scraped by crawl method one by one, as soon as it is scraped"""
+        pass
+
     @abstractmethod
     def run(self, *args, **kwargs):
         """run method should be an entry point of Crawler behavior"""
@@ -26,3 +39,20 @@ class Crawler(metaclass=ABCMeta):
     def analyse(self, data=None):
         """analyse method should return analysed result from scraped data"""
         pass
+
+    def _fields(self, main_columns_only, fields=None):
+        """columns to emit: `fields` if given, otherwise the main or every column.
+        crawlers do not fetch nor parse data of columns not emitted"""
+        if fields is None:
+            fields = self.MAIN_FIELDS if main_columns_only else self.FIELDS
+        return frozenset(fields)
+
+    def _timer(self, stage, cpu=False):
+        """times a `stage` of the crawl (e.g. "search", "parse") into metrics.py,
+        in cpu time of the calling thread if `cpu` is set"""
+        return metrics.timer(
+            "stage_cpu_seconds" if cpu else "stage_seconds",
+            cpu,
+            platform=self.__class__.__name__,
+            stage=stage,
+        )
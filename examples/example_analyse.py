@@ -1,8 +1,9 @@
-import json
 import sys
 
 sys.path.append("..")
-from instagram import Instagram
+from instagram import Instagram, InstagramAnalyser
+import columnar
+import loader
 import pprint
 
 
@@ -12,12 +13,18 @@ def main():
         fname = "Instagram_THORNAPPLE_2020-02-05~2020-02-05.json"
     else:
         fname = sys.argv[1]
-        
-    with open(fname, "r", encoding="utf-8") as f:
-        data = json.loads(f.read())
 
-    i = Instagram()
-    analysed = i.analyse(data)
+    if fname.endswith(".columns"):
+        # saved with `-f columns`: columns are memory-mapped instead of loading every post
+        analyser = InstagramAnalyser()
+        analyser.update_columns(columnar.load(fname))
+        analysed = analyser.result()
+    else:
+        # posts are streamed one by one (.json, .jsonl or .jsonl.gz), with only the columns analysed
+        data = loader.iter_posts(fname, fields=("created", "username", "hashtags"))
+
+        i = Instagram()
+        analysed = i.analyse(data)
 
     pprint.pprint(analysed)
 
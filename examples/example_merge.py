@@ -0,0 +1,24 @@
+import sys
+
+sys.path.append("..")
+from instagram import InstagramAnalyser
+import pprint
+
+
+def main():
+
+    if len(sys.argv) < 2:
+        print(f"usage: {sys.argv[0]} <*_analyser.json> ...")
+        exit(1)
+
+    # e.g. daily crawls of several queries into one rollup
+    analyser = InstagramAnalyser()
+    for fname in sys.argv[1:]:
+        analyser.merge(InstagramAnalyser.load(fname))
+
+    pprint.pprint(analyser.result())
+
+
+if __name__ == "__main__":
+
+    main()
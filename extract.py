@@ -0,0 +1,64 @@
+import threading
+import lxml.html
+from lxml import etree
+
+
+def has_class(cls):
+    """XPath predicate matching elements having `cls` in their class attribute"""
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {cls} ')"
+
+
+def by_class(tags, classes):
+    """XPath list matching `tags` having any of `classes`,
+    tags are searched in the given order (e.g. every div first, then every span)"""
+    predicate = " or ".join(has_class(cls) for cls in classes)
+    return [f"//{tag}[{predicate}]" for tag in tags]
+
+
+class Extractor:
+    """extracts fields from a html document with compiled XPath selectors
+
+    `spec` maps each field to a list of XPath expressions,
+    the first node found (in the order of expressions, then document order) is the field value.
+    elements are converted to their stripped text content, attribute values are stripped.
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+
+        # lxml parsers and compiled XPath are not shared between threads
+        self._local = threading.local()
+
+    def _compiled(self):
+        if not hasattr(self._local, "xpaths"):
+            self._local.parser = lxml.html.HTMLParser(encoding="utf-8")
+            self._local.xpaths = {
+                field: [etree.XPath(xpath) for xpath in xpaths]
+                for field, xpaths in self.spec.items()
+            }
+        return self._local.parser, self._local.xpaths
+
+    def extract(self, text, fields=None):
+        """returns {field: value} for every field in `fields` (default: every field in spec),
+        value is None if nothing matched"""
+        parser, xpaths = self._compiled()
+        if fields is None:
+            fields = xpaths.keys()
+
+        result = {field: None for field in fields}
+        if not text.strip():
+            return result
+
+        document = lxml.html.fromstring(text.encode("utf-8"), parser=parser)
+        for field in fields:
+            for xpath in xpaths[field]:
+                found = xpath(document)
+                if found:
+                    node = found[0]
+                    if isinstance(node, str):
+                        result[field] = node.strip()
+                    else:
+                        result[field] = node.text_content().strip()
+                    break
+
+        return result
@@ -0,0 +1,40 @@
+import asyncio
+import concurrent.futures
+
+
+async def _gather(func, args_list, max_in_flight):
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max_in_flight)
+
+    async def _run(args):
+        async with semaphore:
+            return await loop.run_in_executor(None, func, *args)
+
+    return await asyncio.gather(
+        *[_run(args) for args in args_list], return_exceptions=True
+    )
+
+
+def gather(func, args_list, max_in_flight=1):
+    """run `func(*args)` for every args in `args_list` on an event loop,
+    with at most `max_in_flight` calls running at the same time.
+
+    results are returned in the same order as `args_list`,
+    exceptions raised by `func` are returned in place of its result.
+    """
+    args_list = list(args_list)
+    if not args_list:
+        return []
+
+    max_in_flight = max(1, max_in_flight)
+
+    # blocking calls (requests) are run on a dedicated executor,
+    # so that crawlers running on different threads do not share workers
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight)
+    loop = asyncio.new_event_loop()
+    try:
+        loop.set_default_executor(executor)
+        return loop.run_until_complete(_gather(func, args_list, max_in_flight))
+    finally:
+        loop.close()
+        executor.shutdown(wait=True)
@@ -0,0 +1,173 @@
+import collections
+import hashlib
+import json
+import os
+import pathlib
+import threading
+import time
+import requests
+from requests.structures import CaseInsensitiveDict
+import ratelimit
+import registry
+import metrics
+import config
+
+
+class CacheMiss(requests.exceptions.RequestException):
+    """raised in offline mode when a response is not cached"""
+
+
+class ResponseCache:
+    """content-addressed on-disk cache of http responses
+
+    responses are stored at `<directory>/<key[:2]>/<key>` where key is the hash of the request,
+    as a JSON header line (status, headers, ...) followed by the raw body.
+    least recently used responses are evicted once the cache exceeds `max_size` bytes.
+    """
+
+    def __init__(self, directory, max_size, ttls, offline=False):
+        self.directory = pathlib.Path(directory)
+        self.max_size = max_size
+        self.ttls = ttls
+        self.offline = offline
+        self._lock = threading.Lock()
+        self._size = 0
+
+        # path: size, in least recently used order
+        self._entries = collections.OrderedDict()
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        files = [
+            f
+            for f in self.directory.glob("*/*")
+            if f.is_file() and not f.name.endswith(".tmp")
+        ]
+        for f in sorted(files, key=lambda f: f.stat().st_mtime):
+            size = f.stat().st_size
+            self._entries[str(f)] = size
+            self._size += size
+
+    @staticmethod
+    def key(method, url, params=None, data=None):
+        prepared = requests.Request(method, url, params=params, data=data).prepare()
+        h = hashlib.sha256()
+        h.update(prepared.method.encode())
+        h.update(b"\n")
+        h.update(prepared.url.encode())
+        h.update(b"\n")
+        body = prepared.body or b""
+        h.update(body.encode() if isinstance(body, str) else body)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return self.directory / key[:2] / key
+
+    def get(self, key, endpoint):
+        """cached response of `key`, None if not cached or expired.
+        in offline mode, expired responses are returned as well"""
+        path = self._path(key)
+        try:
+            with open(str(path), "rb") as f:
+                meta = json.loads(f.readline().decode("utf-8"))
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+
+        ttl = self.ttls.get(endpoint, 0)
+        if not self.offline and time.time() - meta["time"] > ttl:
+            return None
+
+        with self._lock:
+            if str(path) in self._entries:
+                self._entries.move_to_end(str(path))
+        os.utime(str(path))
+
+        r = requests.Response()
+        r.status_code = meta["status"]
+        r.url = meta["url"]
+        r.encoding = meta["encoding"]
+        r.headers = CaseInsensitiveDict(meta["headers"])
+        r._content = body
+        return r
+
+    def put(self, key, r):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        meta = {
+            "time": time.time(),
+            "status": r.status_code,
+            "url": r.url,
+            "encoding": r.encoding,
+            "headers": dict(r.headers),
+        }
+
+        tmp = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        with open(str(tmp), "wb") as f:
+            f.write(json.dumps(meta).encode("utf-8"))
+            f.write(b"\n")
+            f.write(r.content)
+        os.replace(str(tmp), str(path))
+
+        with self._lock:
+            self._size -= self._entries.pop(str(path), 0)
+            self._entries[str(path)] = path.stat().st_size
+            self._size += self._entries[str(path)]
+
+            while self._size > self.max_size and len(self._entries) > 1:
+                evicted, size = self._entries.popitem(last=False)
+                self._size -= size
+                try:
+                    os.remove(evicted)
+                except OSError:
+                    pass
+
+
+class CachedSession(ratelimit.RateLimitedSession):
+    """rate limited session serving responses from `cache`
+
+    requests are cached only when `cache=<endpoint type>` is passed,
+    e.g. session.get(url, cache="post"). see config.HTTP_CACHE_TTL for endpoint types.
+    identical requests of those endpoints sent at the same time (e.g. from crawlers of
+    different queries) are coalesced into one request, whether `cache` is set or not.
+    """
+
+    def __init__(self, cache=None):
+        super().__init__()
+        self.cache = cache
+        self._flight = registry.SingleFlight()
+
+    def request(self, method, url, *args, cache=None, **kwargs):
+        if cache is None:
+            return super().request(method, url, *args, **kwargs)
+
+        key = ResponseCache.key(method, url, kwargs.get("params"), kwargs.get("data"))
+        return self._flight.do(
+            key, self._cached_request, key, method, url, *args, cache=cache, **kwargs
+        )
+
+    def _cached_request(self, key, method, url, *args, cache=None, **kwargs):
+        if self.cache is None:
+            return super().request(method, url, *args, **kwargs)
+
+        r = self.cache.get(key, cache)
+        if r is not None:
+            metrics.inc("http_cache_hits_total", endpoint=cache)
+            return r
+
+        if self.cache.offline:
+            raise CacheMiss(f"Not cached: {method} {url} {kwargs.get('params', '')}")
+
+        r = super().request(method, url, *args, **kwargs)
+        if r.status_code == 200:
+            self.cache.put(key, r)
+        return r
+
+
+def create_cache(offline=False):
+    """response cache configured in config.py"""
+    return ResponseCache(
+        config.HTTP_CACHE_DIR,
+        config.HTTP_CACHE_MAX_SIZE,
+        config.HTTP_CACHE_TTL,
+        offline=offline,
+    )
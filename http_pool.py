@@ -0,0 +1,37 @@
+from requests.adapters import HTTPAdapter
+import http_cache
+import config
+
+
+def create_session(pool_maxsize=None, host_pool_maxsize=None, cache=None):
+    """create a rate limited session with pooled keep-alive connections
+
+    the session is safe to be shared between crawler instances (and threads)
+    as long as per-crawler headers are passed per request, not set on the session.
+
+    `pool_maxsize` is the number of connections kept open per host,
+    `host_pool_maxsize` overrides it for specific hosts (e.g. {"blog.naver.com": 8}),
+    `cache` is an optional http_cache.ResponseCache to serve responses from
+    """
+    if pool_maxsize is None:
+        pool_maxsize = config.HTTP_POOL_MAXSIZE
+    if host_pool_maxsize is None:
+        host_pool_maxsize = config.HTTP_HOST_POOL_MAXSIZE
+
+    session = http_cache.CachedSession(cache)
+
+    # block (instead of opening throw-away connections) when a host's pool is exhausted
+    adapter = HTTPAdapter(
+        pool_connections=config.HTTP_POOL_CONNECTIONS,
+        pool_maxsize=pool_maxsize,
+        pool_block=True,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    for host, maxsize in host_pool_maxsize.items():
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=maxsize, pool_block=True)
+        session.mount(f"http://{host}/", adapter)
+        session.mount(f"https://{host}/", adapter)
+
+    return session
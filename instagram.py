@@ -1,20 +1,118 @@
 import sys
+import array
 from datetime import datetime, timedelta
 import json
 import logging
 import pathlib
-import itertools
+import threading
 import collections
+import concurrent.futures
+import itertools
 import instaloader
+import numpy as np
 from crawler import Crawler
+import sink
+import pager
+import aggregate
+import watermark
+import metrics
 import config
 
+_lock = threading.Lock()
+_loaders = {}
+
+
+class LockedRateController(instaloader.RateController):
+    """instaloader's rate controller, safe to be shared by threads.
+    query timestamps are checked and recorded under a lock (sleeping included),
+    so that threads sharing a loader (queries, comment workers) are throttled together
+    """
+
+    def __init__(self, context):
+        super().__init__(context)
+        self._lock = threading.RLock()
+
+    def wait_before_query(self, query_type):
+        with self._lock:
+            super().wait_before_query(query_type)
+
+    def handle_429(self, query_type):
+        with self._lock:
+            super().handle_429(query_type)
+
+
+def _instaloader():
+    return instaloader.Instaloader(rate_controller=LockedRateController)
+
+
+def _create_loader(email, pw, logger):
+    L = _instaloader()
+    if not email:
+        return L
+
+    # reuse the session of previous runs, not to log in (and be challenged) every run
+    session_file = pathlib.Path(config.INSTAGRAM_SESSION_DIR) / f"session-{email}"
+    if session_file.exists():
+        try:
+            L.load_session_from_file(email, str(session_file))
+            if L.test_login() is not None:
+                logger.debug(f"[*] Instagram: reusing session {str(session_file)}")
+                return L
+        except (OSError, instaloader.exceptions.InstaloaderException) as e:
+            logger.debug(f"[*] Instagram: loading session failed ({e})")
+        L = _instaloader()
+
+    try:
+        L.login(email, pw)
+    except instaloader.exceptions.InstaloaderException as e:
+        logger.info(f"[*] Instagram: login failed ({e}), crawling anonymously")
+        return _instaloader()
+
+    session_file.parent.mkdir(parents=True, exist_ok=True)
+    L.save_session_to_file(str(session_file))
+    return L
+
+
+def shared_loader(email="", pw=""):
+    """Instaloader shared by every Instagram crawler in the process,
+    logged in as `email` if given (anonymous otherwise, or when login failed).
+    login sessions are saved in config.INSTAGRAM_SESSION_DIR and reused by following runs
+    """
+    with _lock:
+        if email not in _loaders:
+            _loaders[email] = _create_loader(
+                email, pw, logging.getLogger(config.LOGGER_NAME)
+            )
+        return _loaders[email]
+
 
 class Instagram(Crawler):
+    FIELDS = (
+        "id",
+        "username",
+        "userId",
+        "profileUrl",
+        "postUrl",
+        "created",
+        "imageUrl",
+        "text",
+        "hashtags",
+        "comments",
+        "comments_cnt",
+    )
+    MAIN_FIELDS = ("id", "username", "created", "text", "hashtags", "comments_cnt")
+    # columns identifying a post, kept whenever posts are stored (see store.py)
+    KEY_FIELDS = ("id",)
+
     def __init__(self, *args, **kwargs):
-        self.email = kwargs.get("email", "")  # TODO: not used
-        self.pw = kwargs.get("pw", "")  # TODO: not used
-        self.L = instaloader.Instaloader()
+        self.email = kwargs.get("email") or ""
+        self.pw = kwargs.get("pw") or ""
+        # one logged in context is shared by crawlers of every query
+        self.L = kwargs.get("loader") or shared_loader(self.email, self.pw)
+        # maximum number of posts collecting comments at the same time
+        self.max_in_flight = kwargs.get("max_in_flight", 1)
+        # maximum number of comments (including replies) collected per post
+        self.max_comments = kwargs.get("max_comments", config.MAX_COMMENTS_PER_POST)
         self._query = ""
         self._done = False
         self._data = None
@@ -23,18 +121,100 @@ class Instagram(Crawler):
         )  # when packaged, change this to logger.getLogger(__name__)
         self._analyser = InstagramAnalyser()
 
-    def crawl(self, query, start_date, end_date, main_columns_only):
-        posts = []
+    def _hashtag_posts(self, query):
+        """posts of the hashtag `query`, newest first.
+        instaloader requests pages of posts while iterating, that time is recorded as search
+        """
+        posts = iter(self.L.get_hashtag_posts(query))
+        while True:
+            with self._timer("search"):
+                post = next(posts, None)
+            if post is None:
+                return
+            yield post
+
+    def _parse_comments(self, post):
+        """comments of `post` with their replies, up to `max_comments` comments including replies"""
+        with self._timer("comments"):
+            return self._comments(post)
+
+    def _comments(self, post):
+        comments = []
+        remaining = self.max_comments
+        for comment in post.get_comments():
+            if remaining <= 0:
+                break
+            remaining -= 1
+
+            replies = [
+                {
+                    "id": answer.id,
+                    "userId": answer.owner.userid,
+                    "username": answer.owner.username,
+                    "text": answer.text,
+                    "created": answer.created_at_utc.isoformat(),
+                }
+                for answer in itertools.islice(comment.answers, remaining)
+            ]
+            remaining -= len(replies)
+
+            comments.append(
+                {
+                    "id": comment.id,
+                    "userId": comment.owner.userid,
+                    "username": comment.owner.username,
+                    "text": comment.text,
+                    "created": comment.created_at_utc.isoformat(),
+                    "replies": replies,
+                }
+            )
+        return comments
+
+    def _join_comments(self, post_data, comments):
+        if comments is not None:
+            try:
+                post_data["comments"] = comments.result()
+            except Exception as e:
+                metrics.inc(
+                    "errors_total", platform=self.__class__.__name__, stage="comments"
+                )
+                self._log(f"Parsing comments failed {post_data['id']}", False)
+                self._log(e)
+                post_data["comments"] = []
+        return post_data
+
+    def iter_crawl(
+        self, query, start_date, end_date, main_columns_only, mark=None, fields=None
+    ):
         self._query = query
+        fields = self._fields(main_columns_only, fields)
         cur_date = None
 
+        # comments are collected by workers while hashtag pages are being fetched,
+        # up to `max_pending` posts wait for their comments (in crawled order)
+        workers = None
+        if "comments" in fields:
+            workers = concurrent.futures.ThreadPoolExecutor(self.max_in_flight)
+        max_pending = 2 * self.max_in_flight
+        pending = collections.deque()
+
         try:
-            for post in self.L.get_hashtag_posts(query):
+            for post in self._hashtag_posts(query):
 
                 if post.date_utc.date() < start_date or post.date_utc.date() > end_date:
                     self._log("Post out of range, stop crawling...")
                     break
 
+                # already collected by the previous (incremental) run
+                if mark is not None:
+                    created = post.date_utc.isoformat()
+                    if mark.passed(created):
+                        self._log("Reached collected posts, stop crawling...")
+                        break
+                    if mark.seen(created, post.shortcode):
+                        continue
+                    mark.update(created, post.shortcode)
+
                 # Date logging (for progress checking)
                 if post.date_utc.date() != cur_date:
                     cur_date = post.date_utc.date()
@@ -50,45 +230,46 @@ class Instagram(Crawler):
                     "imageUrl": post.url,
                     "text": post.caption,
                     "hashtags": post.caption_hashtags,
-                    "comments": [
-                        {
-                            "id": comment.id,
-                            "userId": comment.owner.userid,
-                            "username": comment.owner.username,
-                            "text": comment.text,
-                            "created": comment.created_at_utc.isoformat(),
-                            "replies": [
-                                {
-                                    "id": answer.id,
-                                    "userId": answer.owner.userid,
-                                    "username": answer.owner.username,
-                                    "text": answer.text,
-                                    "created": answer.created_at_utc.isoformat(),
-                                }
-                                for answer in comment.answers
-                            ],
-                        }
-                        for comment in post.get_comments()
-                    ],
                 }
 
-                # get_comments returns a generator, therefore comments_cnt is calculated later
-                post_data["comments_cnt"] = len(post_data["comments"])
+                # comments_cnt is the number of comments including replies in post metadata,
+                # whether comments are emitted or not (those are capped by max_comments).
+                # comments are requested page by page, only when they are emitted
+                post_data["comments_cnt"] = post.comments
+                comments = None
+                if workers is not None:
+                    comments = workers.submit(self._parse_comments, post)
+                pending.append((post_data, comments))
 
-                if main_columns_only:
-                    del post_data["profileUrl"]
-                    del post_data["postUrl"]
-                    del post_data["imageUrl"]
-                    del post_data["userId"]
-                    del post_data["comments"]
+                while pending and (
+                    len(pending) > max_pending
+                    or pending[0][1] is None
+                    or pending[0][1].done()
+                ):
+                    post_data = self._join_comments(*pending.popleft())
+                    yield {k: v for k, v in post_data.items() if k in fields}
 
-                posts.append(post_data)
+            while pending:
+                post_data = self._join_comments(*pending.popleft())
+                yield {k: v for k, v in post_data.items() if k in fields}
 
         # when there is no post at all
         except instaloader.exceptions.QueryReturnedNotFoundException:
             pass
 
-        # print(posts)
+        finally:
+            if workers is not None:
+                # comments of posts not emitted (e.g. the consumer stopped) are not requested
+                for _, comments in pending:
+                    comments.cancel()
+                workers.shutdown(wait=False)
+
+    def crawl(self, query, start_date, end_date, main_columns_only, fields=None):
+        posts = list(
+            self.iter_crawl(
+                query, start_date, end_date, main_columns_only, fields=fields
+            )
+        )
         self._done = True
         self._data = posts
         return posts
@@ -102,32 +283,93 @@ class Instagram(Crawler):
         analyse=True,
         save_dir="save",
         main_columns_only=True,
+        save_format="jsonl",
+        incremental=False,
+        fields=None,
     ):
-        posts = self.crawl(query, start_date, end_date, main_columns_only)
+        name = f"{self.__class__.__name__}_{query}_{start_date}~{end_date}"
+        mark = None
+        if incremental:
+            # crawl only posts newer than the previous run,
+            # and merge them into one dataset per query
+            watermarks = watermark.load(save_dir)
+            mark = watermarks.mark(self.__class__.__name__, query)
+            name = f"{self.__class__.__name__}_{query}"
+
+        # counts of incremental runs are kept up to date whether analysed or not,
+        # not to miss posts of this run in the counts of following runs
+        count = analyse or incremental
+
+        # columns the analyser needs
+        if count and fields is not None:
+            fields = set(fields) | {"username", "hashtags", "created"}
+
+        # posts are stored by their key columns, and indexed by date.
+        # appended posts are identified by their key columns as well (see sink.open_sink)
+        if save and (save_format == "sqlite" or incremental):
+            fields = self._fields(main_columns_only, fields).union(
+                self.KEY_FIELDS, ("created",)
+            )
+
+        posts = self.iter_crawl(
+            query, start_date, end_date, main_columns_only, mark=mark, fields=fields
+        )
+
+        # posts are written one by one as soon as they are crawled,
+        # so that memory stays flat and partial results are kept on disk
+        output = None
         if save:
-            dump = json.dumps(posts, indent=2, ensure_ascii=False)
-            directory = pathlib.Path(save_dir)
-            directory.mkdir(parents=True, exist_ok=True)
-            f = (
-                directory
-                / f"{self.__class__.__name__}_{query}_{start_date}~{end_date}.json"
+            output = sink.open_sink(
+                save_dir,
+                name,
+                save_format,
+                append=incremental,
+                platform=self.__class__.__name__,
+                query=query,
+                key_fields=self.KEY_FIELDS,
             )
+            self._log(f"Saving results to {str(output.path)}", False)
 
-            self._log(f"Saving results to {str(f)}", False)
-            with open(str(f), "w", encoding="utf-8") as f:
-                f.write(dump)
+        # counts are saved next to the output, to be merged later (see InstagramAnalyser.merge).
+        # incremental runs add new posts to the counts of previous runs
+        directory = pathlib.Path(save_dir)
+        state_path = directory / f"{name}_analyser.json"
+        if incremental and state_path.exists():
+            analyser = InstagramAnalyser.load(state_path)
+        else:
+            analyser = InstagramAnalyser()
+
+        # crawling goes on in the background while posts are counted and written
+        try:
+            with pager.Prefetcher(posts, config.ANALYSIS_QUEUE_SIZE) as posts:
+                for post in posts:
+                    metrics.inc("posts_total", platform=self.__class__.__name__)
+                    if count:
+                        with self._timer("analyse"):
+                            analyser.update([post])
+                    if output is not None:
+                        with self._timer("save"):
+                            output.write(post)
+        finally:
+            if output is not None:
+                output.close()
+
+        if count:
+            directory.mkdir(parents=True, exist_ok=True)
+            analyser.save(state_path)
+
+        # committed once the counts include the posts of this run
+        if incremental:
+            if not mark.complete:
+                self._log("Crawl incomplete, high-water mark not updated", False)
+            watermarks.commit(self.__class__.__name__, query, mark)
 
         if analyse:
-            self._log(f"Analysing result...")
-            analysed_data = self.analyse()
+            with self._timer("analyse"):
+                analysed_data = analyser.result()
             dump = json.dumps(analysed_data, indent=2, ensure_ascii=False)
 
-            diectory = pathlib.Path(save_dir)
-            directory.mkdir(parents=True, exist_ok=True)
-            f = (
-                diectory
-                / f"{self.__class__.__name__}_{query}_{start_date}~{end_date}_analysed.json"
-            )
+            f = directory / f"{name}_analysed.json"
             self._log(f"Saving analysed results to {str(f)}", False)
             with open(str(f), "w", encoding="utf-8") as f:
                 f.write(dump)
@@ -157,25 +399,238 @@ class Instagram(Crawler):
 
 
 class InstagramAnalyser:
-    def __init__(self):
-        pass
+    """counts hashtags and users of posts, in total and per day / hour of creation
+
+    posts can be counted as soon as they are crawled (see update),
+    they are kept as integer columns (see aggregate.py) and counted in a few vectorized passes.
+    per day / hour, only the `top_k` most common hashtags and users are reported.
+
+    counts are kept per hour, so that the state of analysers can be saved (see save)
+    and merged later (see merge), e.g. daily states into a 90 days rollup,
+    or states of several queries / machines into one.
+    """
+
+    # bump when the state format changes
+    VERSION = 1
+
+    # hour of posts without date (NaT)
+    UNDATED = np.iinfo(np.int64).min
 
-    def _hashtag_usage(self, data):
-        hashtags = itertools.chain.from_iterable([d["hashtags"] for d in data])
-        hashtags_cnt = collections.Counter(hashtags)
-        return collections.OrderedDict(hashtags_cnt.most_common())
+    # (name, numpy datetime unit, hours per bucket) of reported time buckets
+    BUCKETS = (("daily", "D", 24), ("hourly", "h", 1))
+
+    # posts added (see update) are counted this many at a time
+    COUNT_BATCH_SIZE = 100000
+
+    def __init__(self, top_k=None):
+        self.top_k = top_k or config.ANALYSIS_TOP_K
+        self._hashtags = aggregate.Vocabulary()
+        self._usernames = aggregate.Vocabulary()
+
+        # posts not counted yet
+        self._created = []
+        self._username_ids = array.array("q")
+        # per hashtag usage
+        self._hashtag_ids = array.array("q")
+        self._hashtag_posts = array.array("q")
+
+        # counts per hour (since 1970-01-01 utc), posts without date are counted in UNDATED
+        self._posts_cnt = aggregate.Counts()
+        self._hashtags_cnt = aggregate.Counts()
+        self._usernames_cnt = aggregate.Counts()
+
+    def update(self, data):
+        """add posts of `data` (any iterable, e.g. streamed by loader.py) to the counts"""
+        for d in data:
+            post = len(self._created)
+            self._created.append(d["created"])
+            self._username_ids.append(self._usernames.id(d["username"]))
+            for hashtag in d["hashtags"]:
+                self._hashtag_ids.append(self._hashtags.id(hashtag))
+                self._hashtag_posts.append(post)
+            # memory stays flat however many posts are added
+            if len(self._created) >= self.COUNT_BATCH_SIZE:
+                self._count()
+
+    def update_columns(self, dataset):
+        """count every post of a columnar dataset (see columnar.py),
+        reading only the needed columns, without decoding posts one by one"""
+        self._count()
+        # datasets without posts have no columns at all
+        if not len(dataset):
+            return
+
+        if "created" in dataset.kinds:
+            hours = (
+                np.asarray(dataset.column("created"))
+                .astype("datetime64[h]")
+                .astype(np.int64)
+            )
+        else:
+            hours = np.full(len(dataset), self.UNDATED, dtype=np.int64)
+        self._posts_cnt.add(hours, np.zeros(len(hours), dtype=np.int64))
+
+        # codes of the dataset's dictionaries to ids of this analyser's vocabularies
+        if "username" in dataset.kinds:
+            usernames = dataset.column("username")
+            username_ids = np.array(
+                [self._usernames.id(v) for v in usernames.values], dtype=np.int64
+            )
+            codes = np.asarray(usernames.codes, dtype=np.int64)
+            counted = codes >= 0
+            self._usernames_cnt.add(hours[counted], username_ids[codes[counted]])
 
-    def _users(self, data):
-        usernames = [d["username"] for d in data]
-        usernames_cnt = collections.Counter(usernames)
-        return collections.OrderedDict(usernames_cnt.most_common())
+        if "hashtags" not in dataset.kinds:
+            return
+        hashtags = dataset.column("hashtags")
+        hashtag_ids = np.array(
+            [self._hashtags.id(v) for v in hashtags.values], dtype=np.int64
+        )
+        hashtag_posts = np.repeat(
+            np.arange(len(dataset)), np.diff(np.asarray(hashtags.offsets))
+        )
+        codes = np.asarray(hashtags.codes, dtype=np.int64)
+        self._hashtags_cnt.add(hours[hashtag_posts], hashtag_ids[codes])
+
+    def _count(self):
+        """count posts added since the last call"""
+        if not self._created:
+            return
+
+        hours = (
+            np.array(self._created, dtype="datetime64[s]")
+            .astype("datetime64[h]")
+            .astype(np.int64)
+        )
+        hashtag_posts = np.array(self._hashtag_posts, dtype=np.int64)
+        self._posts_cnt.add(hours, np.zeros(len(hours), dtype=np.int64))
+        self._usernames_cnt.add(hours, self._username_ids)
+        self._hashtags_cnt.add(hours[hashtag_posts], self._hashtag_ids)
+
+        self._created = []
+        self._username_ids = array.array("q")
+        self._hashtag_ids = array.array("q")
+        self._hashtag_posts = array.array("q")
+
+    def merge(self, other):
+        """add counts of `other` analyser to this analyser"""
+        self._count()
+        other._count()
+
+        # ids of other's vocabularies in this analyser
+        hashtag_ids = np.array(
+            [self._hashtags.id(v) for v in other._hashtags.values], dtype=np.int64
+        )
+        username_ids = np.array(
+            [self._usernames.id(v) for v in other._usernames.values], dtype=np.int64
+        )
+
+        self._posts_cnt.add(
+            other._posts_cnt.buckets, other._posts_cnt.ids, other._posts_cnt.counts
+        )
+        self._hashtags_cnt.add(
+            other._hashtags_cnt.buckets,
+            hashtag_ids[other._hashtags_cnt.ids],
+            other._hashtags_cnt.counts,
+        )
+        self._usernames_cnt.add(
+            other._usernames_cnt.buckets,
+            username_ids[other._usernames_cnt.ids],
+            other._usernames_cnt.counts,
+        )
+
+    def result(self):
+        self._count()
+        result = {
+            "hashtags_count": aggregate.ranked(
+                self._hashtags_cnt.totals(len(self._hashtags)), self._hashtags
+            ),
+            "users_count": aggregate.ranked(
+                self._usernames_cnt.totals(len(self._usernames)), self._usernames
+            ),
+        }
+
+        for name, unit, hours in self.BUCKETS:
+            # posts without date are counted in totals only
+            posts_cnt = self._posts_cnt.without(self.UNDATED).rebucketed(hours)
+            hashtags_cnt = self._hashtags_cnt.without(self.UNDATED).rebucketed(hours)
+            usernames_cnt = self._usernames_cnt.without(self.UNDATED).rebucketed(hours)
+
+            # every bucket has posts, buckets of posts are sorted and unique
+            labels = posts_cnt.buckets
+            hashtags_ranked = aggregate.ranked_per_bucket(
+                np.searchsorted(labels, hashtags_cnt.buckets),
+                hashtags_cnt.ids,
+                hashtags_cnt.counts,
+                len(labels),
+                self._hashtags,
+                self.top_k,
+            )
+            users_ranked = aggregate.ranked_per_bucket(
+                np.searchsorted(labels, usernames_cnt.buckets),
+                usernames_cnt.ids,
+                usernames_cnt.counts,
+                len(labels),
+                self._usernames,
+                self.top_k,
+            )
+            labels = np.datetime_as_string(
+                labels.astype(f"datetime64[{unit}]"), unit=unit
+            )
+            result[name] = collections.OrderedDict(
+                (
+                    label,
+                    {
+                        "posts_count": int(posts_cnt.counts[i]),
+                        "hashtags_count": hashtags_ranked[i],
+                        "users_count": users_ranked[i],
+                    },
+                )
+                for i, label in enumerate(labels.tolist())
+            )
+
+        return result
 
     def run(self, data):
+        analyser = InstagramAnalyser(self.top_k)
+        analyser.update(data)
+        return analyser.result()
+
+    def state(self):
+        self._count()
         return {
-            "hashtags_count": self._hashtag_usage(data),
-            "users_count": self._users(data),
+            "version": self.VERSION,
+            "hashtags": self._hashtags.values,
+            "usernames": self._usernames.values,
+            "posts_count": self._posts_cnt.state(),
+            "hashtags_count": self._hashtags_cnt.state(),
+            "users_count": self._usernames_cnt.state(),
         }
 
+    @classmethod
+    def from_state(cls, state, top_k=None):
+        if state.get("version") != cls.VERSION:
+            raise ValueError(
+                f"Unsupported analyser state version: {state.get('version')}"
+            )
+
+        analyser = cls(top_k)
+        analyser._hashtags = aggregate.Vocabulary(state["hashtags"])
+        analyser._usernames = aggregate.Vocabulary(state["usernames"])
+        analyser._posts_cnt = aggregate.Counts.from_state(state["posts_count"])
+        analyser._hashtags_cnt = aggregate.Counts.from_state(state["hashtags_count"])
+        analyser._usernames_cnt = aggregate.Counts.from_state(state["users_count"])
+        return analyser
+
+    def save(self, path):
+        with open(str(path), "w", encoding="utf-8") as f:
+            f.write(json.dumps(self.state(), ensure_ascii=False))
+
+    @classmethod
+    def load(cls, path, top_k=None):
+        with open(str(path), "r", encoding="utf-8") as f:
+            return cls.from_state(json.loads(f.read()), top_k)
+
 
 if __name__ == "__main__":
     today = datetime.utcnow()
@@ -0,0 +1,90 @@
+import gzip
+import json
+import pathlib
+import columnar
+
+# characters read at a time from JSON array files
+CHUNK_SIZE = 1024 * 1024
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+
+def _iter_json_array(f):
+    """yields items of a JSON array one by one, reading `f` in chunks,
+    so that only one item is held in memory at a time"""
+    buf = ""
+    pos = 0
+    eof = False
+    started = False
+
+    while True:
+        # skip whitespaces and separators
+        while pos < len(buf) and buf[pos] in _WHITESPACE + ",":
+            pos += 1
+
+        if pos == len(buf):
+            if eof:
+                raise ValueError("Unexpected end of JSON array")
+            # the buffer is trimmed only when refilled, not to copy it after every item
+            buf, pos = f.read(CHUNK_SIZE), 0
+            eof = not buf
+            continue
+
+        if not started:
+            if buf[pos] != "[":
+                raise ValueError("Not a JSON array")
+            started = True
+            pos += 1
+            continue
+
+        if buf[pos] == "]":
+            return
+
+        try:
+            item, end = _decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            # item not read to the end yet
+            if eof:
+                raise
+            chunk = f.read(CHUNK_SIZE)
+            eof = not chunk
+            buf, pos = buf[pos:] + chunk, 0
+            continue
+
+        yield item
+        pos = end
+
+
+def _project(posts, fields):
+    if fields is None:
+        return posts
+    return ({k: v for k, v in post.items() if k in fields} for post in posts)
+
+
+def iter_posts(path, fields=None):
+    """yields posts saved at `path` one by one, without loading the whole file.
+    `.json` (array), `.jsonl`, `.jsonl.gz` files and `.columns` datasets are supported (see sink.py),
+    only `fields` are kept if given (and only those columns are read from `.columns` datasets)
+    """
+    path = pathlib.Path(path)
+    name = path.name
+
+    if name.endswith(".columns"):
+        dataset = columnar.load(path)
+        if fields is not None:
+            fields = [field for field in dataset.columns if field in fields]
+        yield from dataset.rows(fields)
+        return
+
+    if name.endswith(".jsonl.gz"):
+        f = gzip.open(str(path), "rt", encoding="utf-8")
+    else:
+        f = open(str(path), "r", encoding="utf-8")
+
+    with f:
+        if name.endswith(".json"):
+            yield from _project(_iter_json_array(f), fields)
+        else:
+            posts = (json.loads(line) for line in f if line.strip())
+            yield from _project(posts, fields)
@@ -0,0 +1,222 @@
+"""counters and latency histograms of crawls, per stage and per host
+
+every crawler records into the process-wide `collector` (like ratelimit.limiter):
+
+    stage_seconds{platform, stage}          wall time of search / fetch / comments / analyse / save
+    stage_cpu_seconds{platform, stage}      cpu time of the calling thread, for parse
+    posts_total{platform}                   posts emitted
+    errors_total{platform, stage}           posts failed
+    http_request_seconds{host}              latency of http requests (rate limiting excluded)
+    http_responses_total{host, status}      http status counts
+    http_errors_total{host, error}          requests failed without response
+    http_response_bytes_total{host}         bytes downloaded
+    http_cache_hits_total{endpoint}         responses served from the response cache
+    ratelimit_sleep_seconds_total{host}     time slept waiting for the rate limiter
+
+collected metrics are exposed as a JSON or Prometheus text snapshot (see save),
+or served over http while crawling (see serve).
+"""
+
+import bisect
+import contextlib
+import http.server
+import json
+import threading
+import time
+
+# prefix of exposed metric names
+NAMESPACE = "bellorin"
+
+# upper bounds (seconds) of histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    """observed values counted per bucket (`counts[i]`: values <= buckets[i], not cumulative,
+    the last count is for values above every bucket)"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+def _format_bound(bound):
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+
+def _cumulative(counts):
+    total = 0
+    result = []
+    for count in counts:
+        total += count
+        result.append(total)
+    return result
+
+
+class Metrics:
+    """thread-safe counters and histograms, identified by name and labels"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (name, labels): value
+        self._counters = {}
+        # (name, labels): Histogram
+        self._histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, cpu=False, **labels):
+        """observes seconds spent in the block, cpu time of the calling thread if `cpu` is set.
+        failed blocks are observed as well"""
+        clock = time.thread_time if cpu else time.perf_counter
+        start = clock()
+        try:
+            yield
+        finally:
+            self.observe(name, clock() - start, **labels)
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+
+    def snapshot(self):
+        """JSON serializable copy of every metric"""
+        with self._lock:
+            counters = [
+                {"name": f"{NAMESPACE}_{name}", "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self._counters.items())
+            ]
+            histograms = [
+                {
+                    "name": f"{NAMESPACE}_{name}",
+                    "labels": dict(labels),
+                    "count": h.count,
+                    "sum": h.sum,
+                    # cumulative, as in prometheus
+                    "buckets": {
+                        _format_bound(bound): count
+                        for bound, count in zip(
+                            h.buckets + (float("inf"),),
+                            _cumulative(h.counts),
+                        )
+                    },
+                }
+                for (name, labels), h in sorted(self._histograms.items())
+            ]
+        return {"time": time.time(), "counters": counters, "histograms": histograms}
+
+    def prometheus(self):
+        """every metric in the Prometheus text exposition format"""
+        lines = []
+        snapshot = self.snapshot()
+
+        last = None
+        for counter in snapshot["counters"]:
+            if counter["name"] != last:
+                last = counter["name"]
+                lines.append(f"# TYPE {last} counter")
+            labels = _format_labels(sorted(counter["labels"].items()))
+            lines.append(f"{last}{labels} {counter['value']}")
+
+        for h in snapshot["histograms"]:
+            if h["name"] != last:
+                last = h["name"]
+                lines.append(f"# TYPE {last} histogram")
+            labels = sorted(h["labels"].items())
+            for bound, count in h["buckets"].items():
+                le = _format_labels(sorted(labels + [("le", bound)]))
+                lines.append(f"{last}_bucket{le} {count}")
+            lines.append(f"{last}_sum{_format_labels(labels)} {h['sum']}")
+            lines.append(f"{last}_count{_format_labels(labels)} {h['count']}")
+
+        return "\n".join(lines) + "\n"
+
+    def save(self, path):
+        """write a snapshot to `path`, as JSON if it ends with `.json`, otherwise as Prometheus text"""
+        path = str(path)
+        if path.endswith(".json"):
+            text = json.dumps(self.snapshot(), indent=2, ensure_ascii=False)
+        else:
+            text = self.prometheus()
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+
+    def serve(self, port, host="127.0.0.1"):
+        """serve metrics on a background thread, at `/metrics` (Prometheus text)
+        and `/metrics.json`. only local clients can connect unless another `host` is given.
+        returns the server, call `shutdown()` to stop it"""
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = metrics.prometheus().encode("utf-8")
+                    content_type = "text/plain; version=0.0.4; charset=utf-8"
+                elif self.path == "/metrics.json":
+                    body = json.dumps(metrics.snapshot()).encode("utf-8")
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+collector = Metrics()
+
+
+def inc(name, value=1, **labels):
+    collector.inc(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    collector.observe(name, value, **labels)
+
+
+def timer(name, cpu=False, **labels):
+    return collector.timer(name, cpu, **labels)
@@ -2,39 +2,109 @@ from datetime import datetime
 import itertools
 import re
 import json
-import time
 import logging
-import pathlib
-import requests
-from bs4 import BeautifulSoup
 from textrankr import TextRank
 from crawler import Crawler
+import sink
+import watermark
+import fetcher
+import pager
+import http_cache
+import http_pool
+import registry
+import procpool
+import analysis_cache
+import extract
+import metrics
 import config
 
+# 네이버 블로그 게시글에서 추출하는 항목별 XPath 목록 (앞의 XPath부터 찾은 값을 사용)
+#! WARNING: 실험적으로 찾아낸 값으로, 상황에 따라 업데이트 필요
+POST_SPEC = {
+    # 제목 (div 중에서 먼저 찾고, 없으면 span)
+    "title": extract.by_class(
+        ("div", "span"),
+        (
+            "se-title-text",  # 네이버 포스트 스타일 블로그: <div class="se-module se-module-text se-title-text">
+            "se_title",  # 네이버 포스트 스타일 블로그: <div class="se_editView se_title">
+            "itemSubjectBoldfont",  # 예전 버전 블로그: <span class="pcol1 itemSubjectBoldfont">
+        ),
+    ),
+    # 유저 닉네임
+    "nickname": extract.by_class(
+        ("strong",), ("nick",)  # <strong class="itemfont col" id="nickNameArea">
+    ),
+    # 글 내용
+    "text": extract.by_class(
+        ("div",),
+        (
+            "__se_component_area",  # 네이버 포스트 스타일 블로그: <div class="se_component_wrap sect_dsc __se_component_area">
+            "se-main-container",  # 네이버 포스트 스타일 블로그: <div class="se-main-container">
+            "post-view",  # 예전 버전 블로그: <div id="post-view{post_id}" class="post-view pcol2 _param(1) _postViewArea{post_id}">
+        ),
+    ),
+}
+
+post_extractor = extract.Extractor(POST_SPEC)
+
+# number of comments requested per comment api call
+COMMENT_PAGE_SIZE = 50
+
 
 class NaverBlog(Crawler):
+    FIELDS = (
+        "id",
+        "username",
+        "blogname",
+        "blogUrl",
+        "postUrl",
+        "summary",
+        "created",
+        "title",
+        "nickname",
+        "text",
+        "blogId",
+        "comments",
+        "comments_cnt",
+    )
+    MAIN_FIELDS = ("id", "username", "created", "title", "text", "comments_cnt")
+    # columns identifying a post, kept whenever posts are stored (see store.py)
+    KEY_FIELDS = ("username", "id")
+
+    # columns parsed from the post page (i.e. not given by the search api)
+    POST_FIELDS = frozenset(
+        ("title", "nickname", "text", "blogId", "comments", "comments_cnt")
+    )
+
     def __init__(self, *args, **kwargs):
         self.client_id = kwargs["id"]
         self.client_secret = kwargs["secret"]
+        # maximum number of posts fetched at the same time
+        self.max_in_flight = kwargs.get("max_in_flight", 1)
+        # maximum number of comments (including replies) collected per post
+        self.max_comments = kwargs.get("max_comments", config.MAX_COMMENTS_PER_POST)
         self._query = ""
         self._done = False
         self._data = None
         self._logger = logging.getLogger(
             config.LOGGER_NAME
         )  # when packaged, change this to logger.getLogger(__name__)
-        self._analyser = NaverBlogAnalyser()
-        self._session = requests.session()
-
-        self._session.headers.update(
-            {
-                "X-Naver-Client-Id": self.client_id,
-                "X-Naver-Client-Secret": self.client_secret,
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/79.0.3945.130 Safari/537.36",
-                "Referer": "https://blog.naver.com/PostView.nhn",
-            }
+        self._analyser = NaverBlogAnalyser(
+            processes=kwargs.get("analysis_processes", config.ANALYSIS_PROCESSES)
         )
+        # session may be shared with other crawlers,
+        # therefore headers are passed per request instead of set on the session
+        self._session = kwargs.get("session") or http_pool.create_session()
+        # registry may be shared with crawlers of other queries, not to parse a post twice
+        self._registry = kwargs.get("registry") or registry.PostRegistry()
+        self._headers = {
+            "X-Naver-Client-Id": self.client_id,
+            "X-Naver-Client-Secret": self.client_secret,
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/79.0.3945.130 Safari/537.36",
+            "Referer": "https://blog.naver.com/PostView.nhn",
+        }
 
-    def _parse_post(self, username, post_id):
+    def _parse_post(self, username, post_id, fields=POST_FIELDS):
         # self._log(f"trying to collect full post data from {username}/{post_id}")
         url = "https://blog.naver.com/PostView.nhn"
         params = {
@@ -42,80 +112,38 @@ class NaverBlog(Crawler):
             "logNo": post_id,
         }
 
-        r = self._session.get(url=url, params=params)
-        soup = BeautifulSoup(r.text, "html.parser")
-
-        title = ""
-        nickname = ""
-        text = ""
-        comments = []
-        blog_id = re.findall(r"var blogNo = \'(\d+)\';", r.text)[0]
-
-        # 1) title
+        with self._timer("fetch"):
+            r = self._session.get(
+                url=url, params=params, headers=self._headers, cache="post"
+            )
 
-        # 네이버 블로그에서 제목에 사용되는 클래스 목록
-        #! WARNING: 실험적으로 찾아낸 값으로, 상황에 따라 업데이트 필요
-        title_class = (
-            "se-title-text",  # 네이버 포스트 스타일 블로그: <div class="se-module se-module-text se-title-text">
-            "se_title",  # 네이버 포스트 스타일 블로그: <div class="se_editView se_title">
-            "itemSubjectBoldfont",  # 예전 버전 블로그: <span class="pcol1 itemSubjectBoldfont">
-        )
+        with self._timer("parse", cpu=True):
+            found = post_extractor.extract(
+                r.text, [field for field in POST_SPEC if field in fields]
+            )
+            blog_id = re.findall(r"var blogNo = \'(\d+)\';", r.text)[0]
 
-        found = False
-        for tag in itertools.chain(soup.find_all("div"), soup.find_all("span")):
-            tag_class = tag.get("class", [])
-            for tcls in title_class:
-                if tcls in tag_class:
-                    title = tag.text.strip()
-                    found = True
-                    break
-            if found:
-                break
-        else:  # not found
-            self._log(f"NOT FOUND: title ({username}/{post_id})", False)
-
-        # 2) nickname
-
-        # 네이버 블로그에서 유저 닉네임에 사용되는 클래스 목록
-        #! WARNING: 실험적으로 찾아낸 값으로, 상황에 따라 업데이트 필요
-        nickname_class = ("nick",)  # <strong class="itemfont col" id="nickNameArea">
-        found = False
-        for tag in soup.find_all("strong"):
-            tag_class = tag.get("class", [])
-            for ncls in nickname_class:
-                if ncls in tag_class:
-                    nickname = tag.text.strip()
-                    found = True
-                    break
-            if found:
-                break
-        else:  # not found
-            self._log(f"NOT FOUND: nickname ({username}/{post_id})", False)
+            post = {}
+            for field, value in found.items():
+                if value is None:
+                    self._log(f"NOT FOUND: {field} ({username}/{post_id})", False)
+                post[field] = value or ""
+            if "text" in post:
+                post["text"] = re.sub(r"\s+", " ", post["text"])  # compress whitespaces
+            post["blogId"] = blog_id
 
-        # 3) text
+        # 4) comments
+        if "comments" in fields:
+            with self._timer("comments"):
+                post["comments"] = self._parse_comments(username, post_id, blog_id)
+            post["comments_cnt"] = len(post["comments"])
+        elif "comments_cnt" in fields:
+            with self._timer("comments"):
+                post["comments_cnt"] = self._comments_count(username, post_id, blog_id)
 
-        # 네이버 블로그에서 글 내용에 사용되는 클래스 목록
-        #! WARNING: 실험적으로 찾아낸 값으로, 상황에 따라 업데이트 필요
-        text_class = (
-            "__se_component_area",  # 네이버 포스트 스타일 블로그: <div class="se_component_wrap sect_dsc __se_component_area">
-            "se-main-container",  # 네이버 포스트 스타일 블로그: <div class="se-main-container">
-            "post-view",  # 예전 버전 블로그: <div id="post-view{post_id}" class="post-view pcol2 _param(1) _postViewArea{post_id}">
-        )
-        found = False
-        for tag in soup.find_all("div"):
-            tag_class = tag.get("class", [])
-            for tcls in text_class:
-                if tcls in tag_class:
-                    text = tag.text.strip()
-                    text = re.sub(r"\s+", " ", text)  # compress whitespaces
-                    found = True
-                    break
-            if found:
-                break
-        else:  # not found
-            self._log(f"NOT FOUND: text ({username}/{post_id})", False)
+        return post
 
-        # 4) comments
+    def _comment_page(self, blog_id, post_id, page):
         comment_url = "https://apis.naver.com/commentBox/cbox/web_naver_list_jsonp.json"
         params = {
             "ticket": "blog",
@@ -129,61 +157,131 @@ class NaverBlog(Crawler):
             "replyPageSize": "10",
             "useAltSort": "true",
             "initialize": "true",
-            "page": "1",
+            "page": str(page),
             "pageType": "default",
             "indexSize": "10",
-            "pageSize": "50",
+            "pageSize": str(COMMENT_PAGE_SIZE),
             "templateId": "default",
             "_callback": "X",
         }
 
-        self._session.headers.update({})
-        r = self._session.get(url=comment_url, params=params)
+        r = self._session.get(
+            url=comment_url, params=params, headers=self._headers, cache="comment"
+        )
 
         # response: X(<json_data>);
-        _resp = json.loads(r.text.strip()[2:-2])
+        return json.loads(r.text.strip()[2:-2])
+
+    def _comments_count(self, username, post_id, blog_id):
+        """number of comments (replies excluded) of a post, without fetching every comment page.
+        exact when comments fit in the first page, otherwise as reported by the api"""
+        _resp = self._comment_page(blog_id, post_id, 1)
         if not _resp["success"]:
             self._log(f"NOT FOUND: comment ({username}/{post_id})", False)
-        else:
-            # comments returned at timestamp desc order
-            # therefore, to efficiently match comment-reply, reverse order
-            _comments = reversed(_resp["result"]["commentList"])
-
-            for c in _comments:
-                cmt = {
-                    "id": c["commentNo"],
-                    "text": c["contents"],
-                    "username": c["profileUserId"],
-                    "nickname": c["userName"],
-                    "created": c["regTime"],
-                    "replies": [],
-                }
+            return 0
+
+        _comments = _resp["result"]["commentList"]
+        total = _resp["result"].get("pageModel", {}).get("totalRows", 0)
+        if total <= len(_comments):
+            _comments = _comments[: self.max_comments]
+            return sum(1 for c in _comments if c["replyLevel"] <= 1)
+        return min(
+            _resp["result"].get("count", {}).get("comment", total), self.max_comments
+        )
 
-                # 답글
-                if c["replyLevel"] > 1:
-                    for _cmt in comments:
-                        if _cmt["id"] == c["parentCommentNo"]:
-                            _cmt["replies"].append(cmt)
-                            break
-                    else:
-                        self._log(
-                            f"Parent comment not exists: ({username}/{post_id} {cmt['text']})",
-                            False,
-                        )
-                # 댓글
+    def _parse_comments(self, username, post_id, blog_id):
+        comments = []
+
+        _resp = self._comment_page(blog_id, post_id, 1)
+        if not _resp["success"]:
+            self._log(f"NOT FOUND: comment ({username}/{post_id})", False)
+            return comments
+
+        _comments = _resp["result"]["commentList"]
+
+        # fetch remaining pages at once, up to `max_comments` comments
+        page_model = _resp["result"].get("pageModel", {})
+        total = min(page_model.get("totalRows", 0), self.max_comments)
+        last_page = -(-total // COMMENT_PAGE_SIZE)  # ceil
+        _resps = fetcher.gather(
+            self._comment_page,
+            [(blog_id, post_id, page) for page in range(2, last_page + 1)],
+            self.max_in_flight,
+        )
+        for page, _resp in enumerate(_resps, start=2):
+            if isinstance(_resp, Exception) or not _resp["success"]:
+                self._log(f"NOT FOUND: comment page {page} ({username}/{post_id})")
+                continue
+            _comments.extend(_resp["result"]["commentList"])
+
+        # comments returned at timestamp desc order
+        # therefore, to match comment-reply (parent comment is written first), reverse order
+        _comments = reversed(_comments[: self.max_comments])
+
+        index = {}
+        for c in _comments:
+            cmt = {
+                "id": c["commentNo"],
+                "text": c["contents"],
+                "username": c["profileUserId"],
+                "nickname": c["userName"],
+                "created": c["regTime"],
+                "replies": [],
+            }
+
+            # 답글
+            if c["replyLevel"] > 1:
+                if c["parentCommentNo"] in index:
+                    index[c["parentCommentNo"]]["replies"].append(cmt)
                 else:
-                    comments.append(cmt)
-
-        return {
-            "title": title,
-            "nickname": nickname,
-            "text": text,
-            "blogId": blog_id,
-            "comments": comments,
-            "comments_cnt": len(comments),
-        }
+                    self._log(
+                        f"Parent comment not exists: ({username}/{post_id} {cmt['text']})",
+                        False,
+                    )
+            # 댓글
+            else:
+                comments.append(cmt)
+                index[cmt["id"]] = cmt
+
+        return comments
+
+    def _next_search_params(self, r, params, start_date):
+        """params of the search page following `r`, None if there is no need to fetch more"""
+        if not r.ok:
+            return None
 
-    def crawl(self, query, start_date, end_date, main_columns_only, full=True):
+        resp = r.json()
+
+        # results are sorted by date, stop prefetching once `start_date` is reached
+        if any(
+            datetime.strptime(item["postdate"], "%Y%m%d").date() < start_date
+            for item in resp["items"]
+        ):
+            return None
+
+        # no more items
+        if resp["total"] <= resp["start"] + resp["display"]:
+            self._log("No more item, stop crawling...")
+            return None
+
+        # search result maximum exceeded
+        # Reference: https://developers.naver.com/forum/posts/10120
+        if resp["start"] + resp["display"] >= 1100:
+            self._log("No more item, stop crawling...")
+            return None
+
+        return {**params, "start": params["start"] + params["display"]}
+
+    def iter_crawl(
+        self,
+        query,
+        start_date,
+        end_date,
+        main_columns_only,
+        full=True,
+        mark=None,
+        fields=None,
+    ):
         url = "https://openapi.naver.com/v1/search/blog.json"
         display_size = 100
         params = {
@@ -194,100 +292,147 @@ class NaverBlog(Crawler):
         }
 
         self._query = query
-        posts = []
-        stop = False
-        cur_date = None
-        while True:
-            r = self._session.get(url=url, params=params)
-            if not r.ok:
-                if r.status_code == 401:
-                    self._log("ERROR: NAVER API 키를 설정하세요", False)
-                    return posts
-                else:  # Undefined status codes
-                    self._log(f"FAILED ({r.status_code}/{r.text})", False)
-                    return posts
-
-            resp = r.json()
-            for item in resp["items"]:
-                # if not naver blog, skip
-                if "naver" not in item["bloggerlink"]:
-                    continue
-
-                postdate = datetime.strptime(item["postdate"], "%Y%m%d")
-                if postdate.date() < start_date or postdate.date() > end_date:
-                    self._log("Post out of range, stop crawling...")
-                    stop = True
-                    break
-
-                # Date logging (for progress checking)
-                if postdate != cur_date:
-                    cur_date = postdate.date()
-                    self._log(f"crawling on date={cur_date}")
+        fields = self._fields(main_columns_only, fields)
+        post_fields = fields & self.POST_FIELDS
+        # post pages are fetched only for columns not given by the search api
+        full = full and bool(post_fields)
 
-                # parse username and post_id,
-                # `bloggerlink` will be like: `https://blog.naver.com/<username>
-                # `link` will be like: `https://blog.naver.com/<username>?Redirect=Log&logNo=<post_id>`
+        def search(params):
+            with self._timer("search"):
                 try:
-                    username = item["bloggerlink"].split("/")[-1]
-                    post_id = re.findall(r"logNo=(\d+)", item["link"])[0]
-                except:
-                    self._log(
-                        f"username / post ID Parsing FAILED {item['bloggerlink']} / {item['link']}",
-                        False,
+                    return self._session.get(
+                        url=url, params=params, headers=self._headers, cache="search"
                     )
-                    stop = True
-                    break
+                except http_cache.CacheMiss as e:
+                    # offline mode, the page was not requested by previous runs
+                    self._log(f"{e}, stop crawling...", False)
+                    return None
 
-                post_data = {
-                    "id": post_id,
-                    "username": username,
-                    "blogname": item["bloggername"],
-                    "blogUrl": item["bloggerlink"],
-                    "postUrl": item["link"],
-                    "summary": item["description"],
-                    "created": postdate.isoformat(),
-                }
+        stop = False
+        cur_date = None
+        pages = pager.Pager(
+            search,
+            params,
+            lambda r, params: self._next_search_params(r, params, start_date),
+            prefetch=config.SEARCH_PREFETCH_PAGES,
+        )
+        with pages:
+            for r in pages:
+                if r is None or not r.ok:
+                    # older posts in range are not crawled
+                    if mark is not None:
+                        mark.fail()
+                    if r is None:
+                        return
+                    if r.status_code == 401:
+                        self._log("ERROR: NAVER API 키를 설정하세요", False)
+                        return
+                    else:  # Undefined status codes
+                        self._log(f"FAILED ({r.status_code}/{r.text})", False)
+                        return
+
+                resp = r.json()
+                page = []
+                for item in resp["items"]:
+                    # if not naver blog, skip
+                    if "naver" not in item["bloggerlink"]:
+                        continue
+
+                    postdate = datetime.strptime(item["postdate"], "%Y%m%d")
+                    if postdate.date() < start_date or postdate.date() > end_date:
+                        self._log("Post out of range, stop crawling...")
+                        stop = True
+                        break
+
+                    # Date logging (for progress checking)
+                    if postdate != cur_date:
+                        cur_date = postdate.date()
+                        self._log(f"crawling on date={cur_date}")
+
+                    # parse username and post_id,
+                    # `bloggerlink` will be like: `https://blog.naver.com/<username>
+                    # `link` will be like: `https://blog.naver.com/<username>?Redirect=Log&logNo=<post_id>`
+                    try:
+                        username = item["bloggerlink"].split("/")[-1]
+                        post_id = re.findall(r"logNo=(\d+)", item["link"])[0]
+                    except:
+                        self._log(
+                            f"username / post ID Parsing FAILED {item['bloggerlink']} / {item['link']}",
+                            False,
+                        )
+                        if mark is not None:
+                            mark.fail()
+                        stop = True
+                        break
+
+                    # already collected by the previous (incremental) run
+                    if mark is not None:
+                        if mark.passed(postdate.isoformat()):
+                            self._log("Reached collected posts, stop crawling...")
+                            stop = True
+                            break
+                        if mark.seen(postdate.isoformat(), post_id):
+                            continue
+                        mark.update(postdate.isoformat(), post_id)
+
+                    post_data = {
+                        "id": post_id,
+                        "username": username,
+                        "blogname": item["bloggername"],
+                        "blogUrl": item["bloggerlink"],
+                        "postUrl": item["link"],
+                        "summary": item["description"],
+                        "created": postdate.isoformat(),
+                    }
+                    page.append(post_data)
 
                 # naver search api does not reveal full blog data,
                 # therefore, manual crawling needed to get full data.
                 # however, this might be considered as an malicious behavior.
                 if full:
-                    try:
-                        post_full = self._parse_post(username, post_id)
-                        post_data.update(post_full)
-                        time.sleep(config.REQUEST_INTERVAL)  # prevent massive request
-                    except Exception as e:
-                        self._log(f"Parsing blog failed {username} / {post_id}", False)
-                        self._log(e)
-
-                if main_columns_only:
-                    del post_data["blogname"]
-                    del post_data["blogUrl"]
-                    del post_data["postUrl"]
-                    del post_data["summary"]
-                    if full:
-                        del post_data["nickname"]
-                        del post_data["blogId"]
-                        del post_data["comments"]
-
-                posts.append(post_data)
-
-            if stop:
-                break
-
-            # no more items
-            if resp["total"] <= resp["start"] + resp["display"]:
-                self._log("No more item, stop crawling...")
-                break
-
-            # search result maximum exceeded
-            # Reference: https://developers.naver.com/forum/posts/10120
-            if resp["start"] + resp["display"] >= 1100:
-                self._log("No more item, stop crawling...")
-                break
-
-            params["start"] += display_size
+                    posts_full = fetcher.gather(
+                        self._registry.fetch,
+                        [
+                            (
+                                ("naver-blog", p["username"], p["id"], post_fields),
+                                self._parse_post,
+                                p["username"],
+                                p["id"],
+                                post_fields,
+                            )
+                            for p in page
+                        ],
+                        self.max_in_flight,
+                    )
+                    for post_data, post_full in zip(page, posts_full):
+                        if isinstance(post_full, Exception):
+                            metrics.inc(
+                                "errors_total",
+                                platform=self.__class__.__name__,
+                                stage="fetch",
+                            )
+                            self._log(
+                                f"Parsing blog failed {post_data['username']} / {post_data['id']}",
+                                False,
+                            )
+                            self._log(post_full)
+                        else:
+                            post_data.update(post_full)
+
+                for post_data in page:
+                    yield {k: v for k, v in post_data.items() if k in fields}
+
+                if stop:
+                    break
 
+    def crawl(
+        self, query, start_date, end_date, main_columns_only, full=True, fields=None
+    ):
+        posts = list(
+            self.iter_crawl(
+                query, start_date, end_date, main_columns_only, full, fields=fields
+            )
+        )
         self._done = True
         self._data = posts
         return posts
@@ -301,27 +446,78 @@ class NaverBlog(Crawler):
         analyse=True,
         save_dir="save",
         main_columns_only=True,
+        save_format="jsonl",
+        incremental=False,
+        fields=None,
     ):
-        posts = self.crawl(query, start_date, end_date, main_columns_only)
+        name = f"{self.__class__.__name__}_{query}_{start_date}~{end_date}"
+        mark = None
+        if incremental:
+            # crawl only posts newer than the previous run,
+            # and merge them into one dataset per query
+            watermarks = watermark.load(save_dir)
+            mark = watermarks.mark(self.__class__.__name__, query)
+            name = f"{self.__class__.__name__}_{query}"
 
         if analyse:
             self._log(f"Analysing result...")
-            analysed_data = self.analyse(data=posts)
-            for post, _data in zip(posts, analysed_data):
-                post.update(_data)
 
-        if save:
-            dump = json.dumps(posts, indent=2, ensure_ascii=False)
-            directory = pathlib.Path(save_dir)
-            directory.mkdir(parents=True, exist_ok=True)
-            f = (
-                directory
-                / f"{self.__class__.__name__}_{query}_{start_date}~{end_date}.json"
+        # columns the analyser needs
+        if analyse and fields is not None:
+            fields = set(fields) | {"text"}
+
+        # posts are stored by their key columns, and indexed by date.
+        # appended posts are identified by their key columns as well (see sink.open_sink)
+        if save and (save_format == "sqlite" or incremental):
+            fields = self._fields(main_columns_only, fields).union(
+                self.KEY_FIELDS, ("created",)
             )
 
-            self._log(f"Saving results to {str(f)}", False)
-            with open(str(f), "w", encoding="utf-8") as f:
-                f.write(dump)
+        posts = self.iter_crawl(
+            query, start_date, end_date, main_columns_only, mark=mark, fields=fields
+        )
+
+        # posts are written one by one as soon as they are crawled,
+        # so that memory stays flat and partial results are kept on disk
+        output = None
+        if save:
+            output = sink.open_sink(
+                save_dir,
+                name,
+                save_format,
+                append=incremental,
+                platform=self.__class__.__name__,
+                query=query,
+                key_fields=self.KEY_FIELDS,
+            )
+            self._log(f"Saving results to {str(output.path)}", False)
+
+        # crawling goes on in the background while posts are analysed,
+        # posts crawled in the meantime are analysed together to keep every analysis process busy
+        batch_size = self._analyser.batch_size if analyse else 1
+        try:
+            with pager.Prefetcher(posts, config.ANALYSIS_QUEUE_SIZE) as posts:
+                for batch in posts.batches(batch_size):
+                    metrics.inc(
+                        "posts_total", len(batch), platform=self.__class__.__name__
+                    )
+                    if analyse:
+                        with self._timer("analyse"):
+                            analysed_data = self.analyse(data=batch)
+                        for post, analysed in zip(batch, analysed_data):
+                            post.update(analysed)
+                    if output is not None:
+                        with self._timer("save"):
+                            for post in batch:
+                                output.write(post)
+        finally:
+            if output is not None:
+                output.close()
+
+        if incremental:
+            if not mark.complete:
+                self._log("Crawl incomplete, high-water mark not updated", False)
+            watermarks.commit(self.__class__.__name__, query, mark)
 
         # for concurrent.futures to recognize class
         return f"{self.__class__.__name__}: {query} {start_date}~{end_date}"
@@ -347,18 +543,140 @@ class NaverBlog(Crawler):
             self._logger.info(f"[*] {self.__class__.__name__} ({self._query}): {msg}")
 
 
+def _key_sentences(text, n):
+    return TextRank(text).summarize(n)
+
+
 class NaverBlogAnalyser:
-    def __init__(self):
-        pass
+    """extracts key sentences of posts with TextRank
+
+    TextRank is cpu bound, therefore posts are analysed in a process pool shared by every
+    analyser (`processes` workers, None for the number of cpus, 0 to analyse in the calling thread).
+    posts are submitted `chunk_size` at a time, and a post not analysed within `timeout` seconds
+    is left without key sentences.
+    results are cached by the hash of the post text (see analysis_cache.py),
+    so that unchanged posts are not analysed again.
+    """
+
+    # bump when the analysis changes, not to reuse cached results of the previous version
+    VERSION = 1
+
+    def __init__(self, processes=None, chunk_size=None, timeout=None, cache=None):
+        self.processes = processes
+        self.chunk_size = chunk_size or config.ANALYSIS_CHUNK_SIZE
+        self.timeout = config.ANALYSIS_TIMEOUT if timeout is None else timeout
+        self._logger = logging.getLogger(config.LOGGER_NAME)
+
+        # cache configured in config.py by default, opened on first use
+        # (crawlers build an analyser even when they do not analyse)
+        self._cache = cache
+        self._cache_opened = cache is not None
+
+    @property
+    def cache(self):
+        """analysis cache, None if disabled"""
+        if not self._cache_opened:
+            self._cache_opened = True
+            if config.ANALYSIS_CACHE is not None:
+                self._cache = analysis_cache.load(
+                    config.ANALYSIS_CACHE, config.ANALYSIS_CACHE_MAX_ENTRIES
+                )
+        return self._cache
+
+    @cache.setter
+    def cache(self, cache):
+        self._cache = cache
+        self._cache_opened = True
+
+    @property
+    def batch_size(self):
+        """number of posts to pass to `run` at once, to keep every process busy"""
+        if self.processes == 0:
+            return 1
+        return self.chunk_size * procpool.size(self.processes)
+
+    def _key_sentences(self, text, n=1):
+        return procpool.call(_key_sentences, (text, n), self.timeout)
+
+    def _analyse(self, texts, n=1):
+        if self.processes == 0:
+            results = []
+            for text in texts:
+                try:
+                    results.append(self._key_sentences(text, n))
+                except Exception as e:
+                    results.append(e)
+            return results
+
+        return procpool.map_chunks(
+            _key_sentences,
+            [(text, n) for text in texts],
+            self.processes,
+            self.chunk_size,
+            self.timeout,
+        )
 
-    def _key_sentences(self, datum, n=1):
-        text = datum["text"]
-        textrank = TextRank(text)
-        return textrank.summarize(n)
+    def iter_run(self, data, n=1):
+        """yields analysed results of `data` (any iterable of posts) in order,
+        posts are read and analysed `batch_size` at a time, so that datasets larger than memory
+        (e.g. streamed by loader.py) can be analysed"""
+        data = iter(data)
+        while True:
+            batch = list(itertools.islice(data, self.batch_size))
+            if not batch:
+                return
+            yield from self._run_batch(batch, n)
+
+    def run(self, data, n=1):
+        return list(self.iter_run(data, n))
+
+    def _run_batch(self, data, n=1):
+        # posts failed to be fetched have no text
+        texts = [d.get("text") for d in data]
+        keys = [None] * len(data)
+        cached = {}
+        if self.cache is not None:
+            keys = [
+                (
+                    self.cache.key(self.VERSION, {"n": n}, text)
+                    if isinstance(text, str)
+                    else None
+                )
+                for text in texts
+            ]
+            cached = self.cache.get_many([key for key in keys if key is not None])
+
+        # posts of the same text are analysed once, posts without text are not analysed
+        missed = {}
+        for i, (text, key) in enumerate(zip(texts, keys)):
+            if isinstance(text, str) and key not in cached:
+                missed.setdefault(key if key is not None else i, text)
+        results = dict(zip(missed.keys(), self._analyse(list(missed.values()), n)))
+
+        if self.cache is not None:
+            self.cache.put_many(
+                {
+                    key: result
+                    for key, result in results.items()
+                    if isinstance(key, str) and not isinstance(result, Exception)
+                }
+            )
 
-    def run(self, data):
         analysed_data = []
-        for d in data:
-            analysed_data.append({"key_sentences": self._key_sentences(d)})
+        for i, (d, text, key) in enumerate(zip(data, texts, keys)):
+            if not isinstance(text, str):
+                key_sentences = ValueError(f"No text to analyse: {text!r}")
+            elif key in cached:
+                key_sentences = cached[key]
+            else:
+                key_sentences = results[key if key is not None else i]
+
+            if isinstance(key_sentences, Exception):
+                self._logger.debug(
+                    f"[*] {self.__class__.__name__}: Analysing post failed {d.get('id')}"
+                )
+                self._logger.debug(repr(key_sentences))
+                key_sentences = None
+            analysed_data.append({"key_sentences": key_sentences})
 
         return analysed_data
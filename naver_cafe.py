@@ -2,45 +2,135 @@ from datetime import datetime
 import itertools
 import re
 import json
-import time
 import logging
+import os
 import pathlib
-import requests
-from bs4 import BeautifulSoup
+import threading
 from crawler import Crawler
+import sink
+import watermark
+import fetcher
+import http_cache
+import http_pool
+import registry
+import extract
+import metrics
 import config
 
+# 네이버 카페 게시글(ArticleRead.nhn)에서 추출하는 항목별 XPath 목록
+ARTICLE_SPEC = {
+    # 멤버 정보 URL: <a href="/CafeMemberNetworkView.nhn?...&memberid=<username>">
+    "username": [
+        "//a[starts-with(@href, '/CafeMemberNetworkView.nhn') and contains(@href, 'memberid=')]/@href"
+    ],
+    # e.g. <td class="m-tcol-c date">2012.05.15. 20:59</td>
+    "created": ["//td[normalize-space(@class) = 'm-tcol-c date']"],
+    # e.g. <div class="tbody m-tcol-c" id="tbody">
+    "text": ["//div[@id = 'tbody']"],
+}
+
+article_extractor = extract.Extractor(ARTICLE_SPEC)
+
+# number of items requested per search api call
+SEARCH_DISPLAY_SIZE = 100
+# search api does not return items after 1100th item
+# Reference: https://developers.naver.com/forum/posts/10120
+SEARCH_MAX_RESULTS = 1100
+
+
+class ClubIds:
+    """cafe name -> clubid mapping, persisted as a JSON file.
+    also remembers (for the process) cafes whose articles can not be read directly by clubid
+    """
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self._lock = threading.Lock()
+        self._ids = {}
+        self._redirect_only = set()
+        if self.path.exists():
+            with open(str(self.path), "r", encoding="utf-8") as f:
+                self._ids = json.loads(f.read())
+
+    def get(self, cafe_name):
+        return self._ids.get(cafe_name)
+
+    def redirect_only(self, cafe_name):
+        """whether articles of the cafe are read through search result links only"""
+        return cafe_name in self._redirect_only
+
+    def set_redirect_only(self, cafe_name):
+        with self._lock:
+            self._redirect_only.add(cafe_name)
+
+    def set(self, cafe_name, cafe_id):
+        with self._lock:
+            if self._ids.get(cafe_name) == cafe_id:
+                return
+            self._ids[cafe_name] = cafe_id
+
+            # write to a temporary file first, not to corrupt ids on crash
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(self.path.name + ".tmp")
+            with open(str(tmp), "w", encoding="utf-8") as f:
+                f.write(json.dumps(self._ids, indent=2, ensure_ascii=False))
+            os.replace(str(tmp), str(self.path))
+
+
+club_ids = ClubIds(config.NAVER_CAFE_CLUB_IDS)
+
 
 class NaverCafe(Crawler):
+    FIELDS = (
+        "id",
+        "title",
+        "cafename",
+        "cafeUrl",
+        "postUrl",
+        "summary",
+        "username",
+        "created",
+        "text",
+        "cafeId",
+        "article_id",
+        "comments",
+        "comments_cnt",
+    )
+    MAIN_FIELDS = ("id", "title", "username", "created", "text", "comments_cnt")
+    # columns identifying a post, kept whenever posts are stored (see store.py)
+    KEY_FIELDS = ("postUrl",)
+
     def __init__(self, *args, **kwargs):
         self.client_id = kwargs["id"]
         self.client_secret = kwargs["secret"]
+        # maximum number of posts fetched at the same time
+        self.max_in_flight = kwargs.get("max_in_flight", 1)
+        # maximum number of comments (including replies) collected per post
+        self.max_comments = kwargs.get("max_comments", config.MAX_COMMENTS_PER_POST)
         self._query = ""
+        self._post_fields = self._fields(True)
         self._done = False
         self._data = None
         self._logger = logging.getLogger(
             config.LOGGER_NAME
         )  # when packaged, change this to logger.getLogger(__name__)
         self._analyser = None
-        self._session = requests.session()
-
-        self._session.headers.update(
-            {
-                "X-Naver-Client-Id": self.client_id,
-                "X-Naver-Client-Secret": self.client_secret,
-            }
-        )
-
-    def _parse_post(self, url):
-        # 검색을 통한 유입 시뮬레이션
-        self._session.headers.update(
-            {"Referer": f"https://search.naver.com/?&query={self._query}"}
-        )
+        # session may be shared with other crawlers,
+        # therefore headers are passed per request instead of set on the session
+        self._session = kwargs.get("session") or http_pool.create_session()
+        # registry may be shared with crawlers of other queries, not to parse a post twice
+        self._registry = kwargs.get("registry") or registry.PostRegistry()
+        self._headers = {
+            "X-Naver-Client-Id": self.client_id,
+            "X-Naver-Client-Secret": self.client_secret,
+        }
 
+    def _redirect_article_url(self, url, headers):
         # 게시글 불러오는 jsp파일 URL 추출 (cafe.naver.com/ArticleRead.nhn)
         # e.g. https://cafe.naver.com/ArticleRead.nhn?articleid=13787&sc=b29e811a1e4f9b8f1cea36c6ae3baaa8b4d26d8&query=ssafy&where=search&clubid=29884561&tc=naver_search
         # TODO: sc값 생성 원리 파악 후 fake generate
-        r = self._session.get(url=url)
+        with self._timer("fetch"):
+            r = self._session.get(url=url, headers=headers, cache="post")
         article_url = re.findall(r"\$\(\"cafe_main\"\)\.src = \"(.+)\";", r.text)
         if not article_url:
             self._log(f"Failed parsing text ({url})", False)
@@ -49,8 +139,79 @@ class NaverCafe(Crawler):
         article_url = f"https:{article_url[0]}"
         # self._log(f"trying to collect full post data from {article_url}")
 
-        r = self._session.get(url=article_url)
-        soup = BeautifulSoup(r.text, "html.parser")
+        cafe_name = url.rstrip("/").split("/")[-2]
+        club_ids.set(cafe_name, re.findall(r"clubid=(\d+)", article_url)[0])
+        return article_url
+
+    def _article_url(self, url, headers):
+        """ArticleRead.nhn url of the search result link `url`,
+        and whether the search result link was requested to build it"""
+        # `url` will be like: `http://cafe.naver.com/<cafe_name>/<article_id>`
+        cafe_name, article_id = url.rstrip("/").split("/")[-2:]
+
+        # with a known clubid, the redirect page does not need to be requested
+        # (unless direct access failed for the cafe before)
+        cafe_id = club_ids.get(cafe_name)
+        if cafe_id is not None and not club_ids.redirect_only(cafe_name):
+            article_url = f"https://cafe.naver.com/ArticleRead.nhn?clubid={cafe_id}&articleid={article_id}"
+            return article_url, False
+
+        return self._redirect_article_url(url, headers), True
+
+    def _fetch_article(self, url, fields=None):
+        """requests the article of the search result link `url`,
+        returns article url and `fields` extracted from the article page"""
+        # 검색을 통한 유입 시뮬레이션
+        headers = {
+            **self._headers,
+            "Referer": f"https://search.naver.com/?&query={self._query}",
+        }
+
+        article_url, redirected = self._article_url(url, headers)
+        with self._timer("fetch"):
+            r = self._session.get(url=article_url, headers=headers, cache="post")
+        with self._timer("parse", cpu=True):
+            found = article_extractor.extract(r.text, fields)
+
+        # article may not be readable without the search parameters (e.g. `sc`),
+        # retry through the search result link
+        if found["created"] is None and not redirected:
+            self._log(f"Direct article access failed, retry with redirect ({url})")
+            article_url = self._redirect_article_url(url, headers)
+            with self._timer("fetch"):
+                r = self._session.get(url=article_url, headers=headers, cache="post")
+            with self._timer("parse", cpu=True):
+                found = article_extractor.extract(r.text, fields)
+            # the cafe needs the search parameters, other articles go straight to the redirect
+            if found["created"] is not None:
+                club_ids.set_redirect_only(url.rstrip("/").split("/")[-2])
+
+        return article_url, headers, found
+
+    def _probe_date(self, url):
+        """post date of the search result link `url`, without parsing the whole article.
+        None if failed"""
+        # already parsed by a crawler of another query (posts without date are probed again)
+        post = self._registry.get(("naver-cafe", url, self._post_fields))
+        if post is not None and post.get("created"):
+            return datetime.strptime(post["created"], "%Y-%m-%dT%H:%M:%S")
+
+        try:
+            _, _, found = self._fetch_article(url, fields=("created",))
+        except Exception as e:
+            self._log(f"Probing date failed {url}")
+            self._log(e)
+            return None
+
+        if found["created"] is None:
+            return None
+        return datetime.strptime(found["created"], "%Y.%m.%d. %H:%M")
+
+    def _parse_post(self, url, fields=FIELDS):
+        # created is always parsed, to filter posts by date
+        article_url, headers, found = self._fetch_article(
+            url, [f for f in ARTICLE_SPEC if f in fields or f == "created"]
+        )
 
         username = ""
         created = ""
@@ -60,52 +221,46 @@ class NaverCafe(Crawler):
         article_id = re.findall(r"articleid=(\d+)", article_url)[0]
 
         # 1) username
-
-        for tag in soup.find_all("a"):
-            # 멤버 정보 URL
-            href = tag.get("href", "")
-            if href.startswith("/CafeMemberNetworkView.nhn"):
-                _username = re.findall(r"memberid=(.+)[&]*$", href)
-                if _username:
-                    username = _username[0].strip()
-                    break
-        else:  # not found
+        if found.get("username") is not None:
+            username = re.findall(r"memberid=(.+)[&]*$", found["username"])[0].strip()
+        elif "username" in found:  # not found
             self._log(f"NOT FOUND: username ({article_url})", False)
 
         # 2) created
-
-        # e.g. <td class="m-tcol-c date">2012.05.15. 20:59</td>
-        for tag in soup.find_all("td"):
-            _class = " ".join(tag.get("class", ""))
-            if _class == "m-tcol-c date":
-                created = datetime.strptime(
-                    tag.text.strip(), "%Y.%m.%d. %H:%M"
-                ).isoformat()
-                break
+        if found["created"] is not None:
+            created = datetime.strptime(found["created"], "%Y.%m.%d. %H:%M").isoformat()
         else:  # not found
             self._log(f"NOT FOUND: created ({article_url})", False)
 
         # 3) text
-
-        # e.g. <div class="tbody m-tcol-c" id="tbody">
-        for tag in soup.find_all("div"):
-            _id = tag.get("id", "")
-            if _id == "tbody":
-                text = tag.text.strip()
-                text = re.sub(r"\s+", " ", text)  # compress whitespaces
-                break
-        else:  # not found
+        if found.get("text") is not None:
+            text = re.sub(r"\s+", " ", found["text"])  # compress whitespaces
+        elif "text" in found:  # not found
             self._log(f"NOT FOUND: text ({article_url})", False)
 
+        post = {
+            "username": username,
+            "created": created,
+            "text": text,
+            "cafeId": cafe_id,
+            "article_id": article_id,
+        }
+        if "comments" not in fields and "comments_cnt" not in fields:
+            return post
+
         # 4) comments
         comment_url = "https://cafe.naver.com/CommentView.nhn"
         params = {
             "search.clubid": cafe_id,
             "search.articleid": article_id,
         }
-        r = self._session.post(url=comment_url, data=params)
+        with self._timer("comments"):
+            r = self._session.post(
+                url=comment_url, data=params, headers=headers, cache="comment"
+            )
 
-        _comments = r.json()["result"]["list"]
+        _comments = r.json()["result"]["list"][: self.max_comments]
+        index = {}
         for c in _comments:
             cmt = {
                 "id": c["commentid"],
@@ -123,50 +278,159 @@ class NaverCafe(Crawler):
 
             # 답글
             if c["refComment"]:
-                for _cmt in comments:
-                    if _cmt["id"] == c["refcommentid"]:
-                        _cmt["replies"].append(cmt)
-                        break
+                if c["refcommentid"] in index:
+                    index[c["refcommentid"]]["replies"].append(cmt)
             # 댓글
             else:
                 comments.append(cmt)
+                index[cmt["id"]] = cmt
 
-        return {
-            "username": username,
-            "created": created,
-            "text": text,
-            "cafeId": cafe_id,
-            "article_id": article_id,
-            "comments": comments,
-            "comments_cnt": len(comments),
-        }
+        post["comments"] = comments
+        post["comments_cnt"] = len(comments)
+        return post
 
-    def crawl(self, query, start_date, end_date, main_columns_only):
+    def _search_page(self, query, start):
+        """search api response of the page starting at `start` (1-based), None if failed"""
         url = "https://openapi.naver.com/v1/search/cafearticle.json"
-        display_size = 100
         params = {
             "query": query,
-            "display": display_size,
-            "start": 1,
+            "display": SEARCH_DISPLAY_SIZE,
+            "start": start,
             "sort": "date",
         }
 
+        with self._timer("search"):
+            try:
+                r = self._session.get(
+                    url=url, params=params, headers=self._headers, cache="search"
+                )
+            except http_cache.CacheMiss as e:
+                # offline mode, the page was not requested by previous runs
+                self._log(str(e), False)
+                return None
+        if not r.ok:
+            if r.status_code == 401:
+                self._log("ERROR: NAVER API 키를 설정하세요", False)
+            else:  # Undefined status codes
+                self._log(f"FAILED ({r.status_code}/{r.text})", False)
+            return None
+
+        return r.json()
+
+    def _items(self, query, pages, lo, hi):
+        """search result items in index range [lo, hi),
+        `pages` maps page start to its items (None for pages failed to fetch),
+        pages not fetched yet are requested concurrently
+        """
+        if hi <= lo:
+            return []
+
+        # pages holding indexes lo to hi - 1
+        starts = range(
+            lo // SEARCH_DISPLAY_SIZE * SEARCH_DISPLAY_SIZE + 1,
+            (hi - 1) // SEARCH_DISPLAY_SIZE * SEARCH_DISPLAY_SIZE + 2,
+            SEARCH_DISPLAY_SIZE,
+        )
+        missing = [start for start in starts if start not in pages]
+        resps = fetcher.gather(
+            self._search_page, [(query, start) for start in missing], self.max_in_flight
+        )
+        for start, resp in zip(missing, resps):
+            if isinstance(resp, Exception) or resp is None:
+                pages[start] = None
+            else:
+                pages[start] = resp["items"]
+
+        items = []
+        for i in range(lo, hi):
+            start = i // SEARCH_DISPLAY_SIZE * SEARCH_DISPLAY_SIZE + 1
+            page = pages[start] or []
+            if i - start + 1 < len(page):
+                items.append(page[i - start + 1])
+        return items
+
+    def _date_boundary(self, query, pages, probed, lo, hi, predicate):
+        """first index in [lo, hi) whose probed post date satisfies `predicate`,
+        search results are sorted by date desc,
+        therefore `predicate` should be false before the boundary and true after it"""
+
+        def probe(i):
+            if i not in probed:
+                item = self._items(query, pages, i, i + 1)
+                probed[i] = self._probe_date(item[0]["link"]) if item else None
+            return predicate(probed[i])
+
+        # boundaries are usually close to the most recent posts,
+        # therefore narrow the range with exponentially growing steps first
+        i, step = lo, 1
+        while i < hi:
+            if probe(i):
+                hi = i
+                break
+            lo = i + 1
+            i, step = lo + step, step * 2
+
+        # then binary search
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if probe(mid):
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def iter_crawl(
+        self, query, start_date, end_date, main_columns_only, mark=None, fields=None
+    ):
         self._query = query
-        posts = []
-        stop = False
+        self._post_fields = fields = self._fields(main_columns_only, fields)
         cur_date = None
-        while True:
-            r = self._session.get(url=url, params=params)
-            if not r.ok:
-                if r.status_code == 401:
-                    self._log("ERROR: NAVER API 키를 설정하세요", False)
-                    return posts
-                else:  # Undefined status codes
-                    self._log(f"FAILED ({r.status_code}/{r.text})", False)
-                    return posts
-
-            resp = r.json()
-            for item in resp["items"]:
+
+        resp = self._search_page(query, 1)
+        if resp is None:
+            if mark is not None:
+                mark.fail()
+            return
+
+        # search result maximum exceeded
+        # Reference: https://developers.naver.com/forum/posts/10120
+        total = min(resp["total"], SEARCH_MAX_RESULTS)
+        pages = {1: resp["items"]}
+
+        #! Naver Cafe search api does not crawl post creation date,
+        #! therefore, the date range is located by probing dates of few articles first,
+        #! then only the articles in range are fully crawled
+        probed = {}
+        lo = self._date_boundary(
+            query,
+            pages,
+            probed,
+            0,
+            total,
+            # probing failure is considered as in range, not to skip any post
+            lambda created: created is None or created.date() <= end_date,
+        )
+        hi = self._date_boundary(
+            query,
+            pages,
+            probed,
+            lo,
+            total,
+            lambda created: created is not None
+            and (
+                created.date() < start_date
+                or (mark is not None and mark.passed(created.isoformat()))
+            ),
+        )
+        self._log(
+            f"Posts in range: {lo}~{hi} of {total} search results ({len(probed)} probes)"
+        )
+
+        for chunk in range(lo, hi, SEARCH_DISPLAY_SIZE):
+            page = []
+            for item in self._items(
+                query, pages, chunk, min(chunk + SEARCH_DISPLAY_SIZE, hi)
+            ):
 
                 # parse postId,
                 # `link` will be like: `http://cafe.naver.com/<cafe_name>/<post_id>`
@@ -176,8 +440,7 @@ class NaverCafe(Crawler):
                     self._log(
                         f"post ID Parsing FAILED {item['link']}", False,
                     )
-                    stop = True
-                    break
+                    continue
 
                 post_data = {
                     "id": postId,
@@ -187,58 +450,77 @@ class NaverCafe(Crawler):
                     "postUrl": item["link"],
                     "summary": item["description"],
                 }
+                page.append(post_data)
+
+            # naver search api does not reveal full blog data,
+            # therefore, manual crawling needed to get full data.
+            # however, this might be considered as an malicious behavior.
+            posts_full = fetcher.gather(
+                self._registry.fetch,
+                [
+                    (
+                        ("naver-cafe", p["postUrl"], fields),
+                        self._parse_post,
+                        p["postUrl"],
+                        fields,
+                    )
+                    for p in page
+                ],
+                self.max_in_flight,
+            )
+            for post_data, post_full in zip(page, posts_full):
+                if isinstance(post_full, Exception):
+                    metrics.inc(
+                        "errors_total", platform=self.__class__.__name__, stage="fetch"
+                    )
+                    self._log(f"Parsing cafe failed {post_data['postUrl']}", False)
+                    self._log(post_full)
+                    # the post is crawled again by the next (incremental) run
+                    if mark is not None:
+                        mark.fail()
+                    continue
 
-                # naver search api does not reveal full blog data,
-                # therefore, manual crawling needed to get full data.
-                # however, this might be considered as an malicious behavior.
-                #! Naver Cafe search api does not crawl post creation date,
-                #! therefore, manual crawling is *necessary*
-                try:
-                    post_full = self._parse_post(item["link"])
-                    post_data.update(post_full)
-                    time.sleep(config.REQUEST_INTERVAL)  # prevent massive request
-                except Exception as e:
-                    self._log(f"Parsing cafe failed {item['link']}", False)
-                    self._log(e)
+                post_data.update(post_full)
 
+                # article date not found, the post can not be placed in the range
+                if not post_data["created"]:
+                    self._log(
+                        f"Post without date, skipped {post_data['postUrl']}", False
+                    )
+                    continue
+
+                # boundary is located by probing, results may not be strictly sorted around it
                 postdate = datetime.strptime(post_data["created"], "%Y-%m-%dT%H:%M:%S")
                 if postdate.date() < start_date or postdate.date() > end_date:
-                    self._log("Post out of range, stop crawling...")
-                    stop = True
-                    break
+                    self._log("Post out of range, skipped")
+                    continue
+
+                # already collected by the previous (incremental) run
+                if mark is not None:
+                    if mark.passed(post_data["created"]):
+                        self._log("Reached collected posts, skipped")
+                        continue
+                    if mark.seen(post_data["created"], post_data["id"]):
+                        continue
+                    mark.update(post_data["created"], post_data["id"])
 
                 # Date logging (for progress checking)
                 if postdate != cur_date:
                     cur_date = postdate.date()
                     self._log(f"crawling on date={cur_date}")
 
-                if main_columns_only:
-                    del post_data["cafename"]
-                    del post_data["cafeUrl"]
-                    del post_data["postUrl"]
-                    del post_data["summary"]
-                    del post_data["cafeId"]
-                    del post_data["comments"]
-                    del post_data["article_id"]
-
-                posts.append(post_data)
-
-            if stop:
-                break
-
-            # no more items
-            if resp["total"] <= resp["start"] + resp["display"]:
-                self._log("No more item, stop crawling...")
-                break
-
-            # search result maximum exceeded
-            # Reference: https://developers.naver.com/forum/posts/10120
-            if resp["start"] + resp["display"] >= 1100:
-                self._log("No more item, stop crawling...")
-                break
+                yield {k: v for k, v in post_data.items() if k in fields}
 
-            params["start"] += display_size
+        # posts of pages failed to fetch were not crawled
+        if mark is not None and None in pages.values():
+            mark.fail()
 
+    def crawl(self, query, start_date, end_date, main_columns_only, fields=None):
+        posts = list(
+            self.iter_crawl(
+                query, start_date, end_date, main_columns_only, fields=fields
+            )
+        )
         self._done = True
         self._data = posts
         return posts
@@ -252,20 +534,59 @@ class NaverCafe(Crawler):
         analyse=True,
         save_dir="save",
         main_columns_only=True,
+        save_format="jsonl",
+        incremental=False,
+        fields=None,
     ):
-        posts = self.crawl(query, start_date, end_date, main_columns_only)
-        if save:
-            dump = json.dumps(posts, indent=2, ensure_ascii=False)
-            directory = pathlib.Path(save_dir)
-            directory.mkdir(parents=True, exist_ok=True)
-            f = (
-                directory
-                / f"{self.__class__.__name__}_{query}_{start_date}~{end_date}.json"
+        name = f"{self.__class__.__name__}_{query}_{start_date}~{end_date}"
+        mark = None
+        if incremental:
+            # crawl only posts newer than the previous run,
+            # and merge them into one dataset per query
+            watermarks = watermark.load(save_dir)
+            mark = watermarks.mark(self.__class__.__name__, query)
+            name = f"{self.__class__.__name__}_{query}"
+
+        # posts are stored by their key columns, and indexed by date.
+        # appended posts are identified by their key columns as well (see sink.open_sink)
+        if save and (save_format == "sqlite" or incremental):
+            fields = self._fields(main_columns_only, fields).union(
+                self.KEY_FIELDS, ("created",)
             )
 
-            self._log(f"Saving results to {str(f)}", False)
-            with open(str(f), "w", encoding="utf-8") as f:
-                f.write(dump)
+        posts = self.iter_crawl(
+            query, start_date, end_date, main_columns_only, mark=mark, fields=fields
+        )
+
+        # posts are written one by one as soon as they are crawled,
+        # so that memory stays flat and partial results are kept on disk
+        output = None
+        if save:
+            output = sink.open_sink(
+                save_dir,
+                name,
+                save_format,
+                append=incremental,
+                platform=self.__class__.__name__,
+                query=query,
+                key_fields=self.KEY_FIELDS,
+            )
+            self._log(f"Saving results to {str(output.path)}", False)
+
+        try:
+            for post in posts:
+                metrics.inc("posts_total", platform=self.__class__.__name__)
+                if output is not None:
+                    with self._timer("save"):
+                        output.write(post)
+        finally:
+            if output is not None:
+                output.close()
+
+        if incremental:
+            if not mark.complete:
+                self._log("Crawl incomplete, high-water mark not updated", False)
+            watermarks.commit(self.__class__.__name__, query, mark)
 
         # TODO
         # if analyse:
@@ -0,0 +1,126 @@
+import queue
+import threading
+
+_DONE = object()
+
+
+class Prefetcher:
+    """consumes `iterable` on a background thread,
+    keeping up to `size` items ahead of the consumer
+
+    exceptions raised while iterating are re-raised to the consumer.
+
+    usage:
+        with Prefetcher(iterable) as items:
+            for item in items:
+                ...
+    """
+
+    def __init__(self, iterable, size=1):
+        self._iterable = iterable
+        self._queue = queue.Queue(maxsize=max(1, size))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._started = False
+
+    def _put(self, item):
+        # do not block forever when the consumer stopped reading
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        iterator = iter(self._iterable)
+        try:
+            for item in iterator:
+                if not self._put(item) or self._stop.is_set():
+                    break
+            else:
+                self._put(_DONE)
+        except Exception as e:
+            self._put(e)
+            self._put(_DONE)
+        finally:
+            # let generators clean up (e.g. stop their own prefetching) on this thread
+            if hasattr(iterator, "close"):
+                iterator.close()
+
+    def _get(self, block=True):
+        item = self._queue.get(block)
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def __iter__(self):
+        for batch in self.batches(1):
+            yield batch[0]
+
+    def batches(self, max_size):
+        """yields lists of up to `max_size` items, as many as are ready without waiting
+        (but at least one)"""
+        if not self._started:
+            self._started = True
+            self._thread.start()
+
+        while True:
+            item = self._get()
+            if item is _DONE:
+                return
+
+            batch = [item]
+            while len(batch) < max_size:
+                try:
+                    item = self._get(block=False)
+                except queue.Empty:
+                    break
+                except Exception:
+                    # items gathered before the error are delivered first
+                    yield batch
+                    raise
+                if item is _DONE:
+                    yield batch
+                    return
+                batch.append(item)
+            yield batch
+
+    def close(self):
+        """stop consuming `iterable` in advance"""
+        self._stop.set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Pager(Prefetcher):
+    """fetches search result pages on a background thread,
+    keeping up to `prefetch` pages ahead of the consumer
+
+    `fetch(params)` requests a page and returns the response,
+    `next_params(response, params)` returns params of the next page,
+    or None when there is nothing more to fetch (e.g. the page already reached `start_date`)
+
+    usage:
+        with Pager(fetch, params, next_params) as pages:
+            for r in pages:
+                ...
+    """
+
+    def __init__(self, fetch, params, next_params, prefetch=1):
+        self._fetch = fetch
+        self._params = params
+        self._next_params = next_params
+        super().__init__(self._pages(), prefetch)
+
+    def _pages(self):
+        params = self._params
+        while params is not None:
+            r = self._fetch(params)
+            yield r
+            params = self._next_params(r, params)
@@ -0,0 +1,119 @@
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import os
+import signal
+import threading
+
+_lock = threading.Lock()
+_executors = {}
+
+
+class Timeout(Exception):
+    """raised in a worker when a call exceeds its time limit"""
+
+
+def size(processes=None):
+    """number of worker processes of a pool of `processes` (None for the number of cpus)"""
+    return processes or os.cpu_count() or 1
+
+
+def _context():
+    # workers are not forked from crawler threads (locks held by other threads would be copied)
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context(
+        "forkserver" if "forkserver" in methods else "spawn"
+    )
+
+
+def executor(processes=None):
+    """process pool of `processes` workers, shared by every caller in the process.
+    workers are started lazily and shut down at exit"""
+    processes = size(processes)
+    with _lock:
+        if processes not in _executors:
+            _executors[processes] = concurrent.futures.ProcessPoolExecutor(
+                processes, mp_context=_context()
+            )
+        return _executors[processes]
+
+
+def _discard(processes, pool):
+    """forget the broken `pool`, the next caller gets a new one"""
+    processes = size(processes)
+    with _lock:
+        if _executors.get(processes) is pool:
+            del _executors[processes]
+    # futures of a broken pool have failed already, nothing is left to cancel
+    pool.shutdown(wait=False)
+
+
+def _alarm(signum, frame):
+    raise Timeout()
+
+
+def call(func, args, timeout=None):
+    """`func(*args)`, raising Timeout after `timeout` seconds.
+    the limit is enforced with SIGALRM, i.e. only on unix and in the main thread of a process
+    (which is where workers run their tasks)"""
+    if (
+        not timeout
+        or not hasattr(signal, "SIGALRM")
+        or threading.current_thread() is not threading.main_thread()
+    ):
+        return func(*args)
+
+    previous = signal.signal(signal.SIGALRM, _alarm)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return func(*args)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def _call_chunk(func, chunk, timeout):
+    results = []
+    for args in chunk:
+        try:
+            results.append(call(func, args, timeout))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def map_chunks(func, args_list, processes=None, chunk_size=1, timeout=None):
+    """`func(*args)` for every args in `args_list`, run in the shared process pool.
+
+    args are submitted `chunk_size` at a time, so that pickling and scheduling are paid per
+    chunk rather than per call. each call is limited to `timeout` seconds (see `call`).
+    results are in the order of args_list, a call that failed (or timed out)
+    results in its exception instead. `func` must be a module level function.
+    """
+    chunks = [
+        args_list[i : i + chunk_size] for i in range(0, len(args_list), chunk_size)
+    ]
+
+    # a pool broken by a previous caller is replaced once
+    for retry in (True, False):
+        pool = executor(processes)
+        try:
+            futures = [
+                pool.submit(_call_chunk, func, chunk, timeout) for chunk in chunks
+            ]
+            break
+        except BrokenProcessPool:
+            _discard(processes, pool)
+            if not retry:
+                raise
+
+    results = []
+    for chunk, future in zip(chunks, futures):
+        try:
+            results.extend(future.result())
+        except Exception as e:
+            # the worker died (e.g. killed), every call of the chunk failed
+            if isinstance(e, BrokenProcessPool):
+                _discard(processes, pool)
+            results.extend([e] * len(chunk))
+    return results
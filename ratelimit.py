@@ -0,0 +1,101 @@
+import fnmatch
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+import metrics
+import config
+
+
+class TokenBucket:
+    """token bucket refilled with `rate` tokens per second, holding at most `burst` tokens"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """take `tokens` from the bucket, blocking until they are available.
+        returns seconds slept"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._last) * self.rate
+            )
+            self._last = now
+
+            # tokens are reserved before sleeping (the bucket may go negative),
+            # so that waiting threads are served in the order they arrived
+            self._tokens -= tokens
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class HostRateLimiter:
+    """process-wide rate limiter, one token bucket per host
+
+    `limits` maps host patterns (e.g. `blog.naver.com`, `*.tistory.com`) to (rate, burst),
+    hosts not matching any pattern share the `default` limit per host
+    """
+
+    def __init__(self, limits, default=None):
+        self._limits = limits
+        self._default = default
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _limit(self, host):
+        if host in self._limits:
+            return self._limits[host]
+        for pattern, limit in self._limits.items():
+            if fnmatch.fnmatch(host, pattern):
+                return limit
+        return self._default
+
+    def _bucket(self, host):
+        with self._lock:
+            if host not in self._buckets:
+                limit = self._limit(host)
+                self._buckets[host] = TokenBucket(*limit) if limit else None
+            return self._buckets[host]
+
+    def acquire(self, url):
+        """wait until a request to `url` is allowed. returns seconds slept"""
+        bucket = self._bucket(urlsplit(url).hostname or "")
+        if bucket is None:
+            return 0
+        return bucket.acquire()
+
+
+limiter = HostRateLimiter(config.RATE_LIMITS, config.DEFAULT_RATE_LIMIT)
+
+
+class RateLimitedSession(requests.Session):
+    """requests session which acquires from the shared limiter before each request,
+    latency, status and size of responses are recorded per host (see metrics.py)"""
+
+    def request(self, method, url, *args, **kwargs):
+        host = urlsplit(url).hostname or ""
+        slept = limiter.acquire(url)
+        if slept > 0:
+            metrics.inc("ratelimit_sleep_seconds_total", slept, host=host)
+
+        start = time.perf_counter()
+        try:
+            r = super().request(method, url, *args, **kwargs)
+        except Exception as e:
+            metrics.inc("http_errors_total", host=host, error=e.__class__.__name__)
+            raise
+
+        metrics.observe("http_request_seconds", time.perf_counter() - start, host=host)
+        metrics.inc("http_responses_total", host=host, status=r.status_code)
+        # streamed bodies are not read yet
+        if not kwargs.get("stream"):
+            metrics.inc("http_response_bytes_total", len(r.content), host=host)
+        return r
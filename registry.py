@@ -0,0 +1,91 @@
+import collections
+import concurrent.futures
+import threading
+import config
+
+
+class SingleFlight:
+    """coalesces concurrent calls sharing the same key into a single call,
+    every caller gets the result (or the exception) of that call"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = concurrent.futures.Future()
+                self._calls[key] = future
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class PostRegistry:
+    """run-level registry of parsed posts keyed by (platform, post id)
+
+    crawlers running for different queries share a registry (see run.py),
+    so that a post found by several queries is fetched and parsed once
+    and the result is handed to every crawler that found it.
+    failed fetches are not registered, they are retried by the next crawler.
+
+    only the `max_posts` most recently used posts are kept, so that memory stays flat:
+    crawlers of different queries run at the same time, and find shared posts close together.
+    """
+
+    def __init__(self, max_posts=None):
+        self.max_posts = max_posts or config.POST_REGISTRY_MAX_POSTS
+        self._lock = threading.Lock()
+        # key: post, in least recently used order
+        self._posts = collections.OrderedDict()
+        self._flight = SingleFlight()
+
+    def _get(self, key):
+        with self._lock:
+            post = self._posts.get(key)
+            if post is not None:
+                self._posts.move_to_end(key)
+            return post
+
+    def get(self, key):
+        """registered post of `key`, None if not fetched yet (or evicted)"""
+        post = self._get(key)
+        return dict(post) if post is not None else None
+
+    def _fetch(self, key, func, *args):
+        # registered by a call finished since `fetch` looked it up
+        post = self._get(key)
+        if post is not None:
+            return post
+
+        post = func(*args)
+        # registered before other callers of `key` leave the single flight
+        with self._lock:
+            self._posts[key] = post
+            while len(self._posts) > self.max_posts:
+                self._posts.popitem(last=False)
+        return post
+
+    def fetch(self, key, func, *args):
+        """registered post of `key`, or the result of `func(*args)` after registering it"""
+        post = self._get(key)
+        if post is None:
+            post = self._flight.do(key, self._fetch, key, func, *args)
+
+        # every crawler updates its own copy with its columns
+        return dict(post)
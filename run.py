@@ -3,6 +3,11 @@ from datetime import datetime, timedelta
 import logging
 import sys
 import concurrent.futures
+import http_pool
+import http_cache
+import registry
+import metrics
+import sink
 from instagram import Instagram
 from naver_blog import NaverBlog
 from naver_cafe import NaverCafe
@@ -10,21 +15,35 @@ from tistory import Tistory
 import config
 
 # lazy class generation, prevent side-effects
+# resources shared between crawlers (e.g. session) are injected when generating
 def class_gen(c, *args, **kwargs):
-    return lambda: c(*args, **kwargs)
+    return lambda **shared: c(*args, **kwargs, **shared)
 
 
 target2crawler = {
     "instagram": class_gen(
-        Instagram, email=config.INSTAGRAM_EMAIL, pw=config.INSTAGRAM_PASSWORD
+        Instagram,
+        email=config.INSTAGRAM_EMAIL,
+        pw=config.INSTAGRAM_PASSWORD,
+        max_in_flight=config.INSTAGRAM_MAX_IN_FLIGHT,
     ),
     "naver-blog": class_gen(
-        NaverBlog, id=config.NAVER_CLIENT_ID, secret=config.NAVER_CLIENT_SECRET
+        NaverBlog,
+        id=config.NAVER_CLIENT_ID,
+        secret=config.NAVER_CLIENT_SECRET,
+        max_in_flight=config.NAVER_BLOG_MAX_IN_FLIGHT,
     ),
     "naver-cafe": class_gen(
-        NaverCafe, id=config.NAVER_CLIENT_ID, secret=config.NAVER_CLIENT_SECRET
+        NaverCafe,
+        id=config.NAVER_CLIENT_ID,
+        secret=config.NAVER_CLIENT_SECRET,
+        max_in_flight=config.NAVER_CAFE_MAX_IN_FLIGHT,
+    ),
+    "tistory": class_gen(
+        Tistory,
+        key=config.KAKAO_REST_API_KEY,
+        max_in_flight=config.TISTORY_MAX_IN_FLIGHT,
     ),
-    "tistory": class_gen(Tistory, key=config.KAKAO_REST_API_KEY),
 }
 
 targets = target2crawler.keys()
@@ -76,6 +95,52 @@ def parse_args():
         help="Add additional columns to scrapped data",
     )
 
+    parser.add_argument(
+        "--fields",
+        nargs="+",
+        default=None,
+        help="Columns to collect, overrides --all-columns. other columns are neither fetched nor parsed",
+    )
+
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Crawl only posts newer than the previous incremental run, and merge them into the saved data",
+    )
+
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Serve post pages and comments from the on-disk response cache when possible",
+    )
+
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Replay cached responses only, never send requests (implies --cache). Instagram is skipped",
+    )
+
+    parser.add_argument(
+        "-f",
+        "--format",
+        default="jsonl",
+        choices=sink.FORMATS.keys(),
+        help="Output format of scrapped data (default: jsonl)",
+    )
+
+    parser.add_argument(
+        "--metrics",
+        default=None,
+        help="Save per-stage metrics at the end of the run, as JSON if the file ends with .json, otherwise as Prometheus text",
+    )
+
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Serve live metrics at http://localhost:<port>/metrics (Prometheus text) and /metrics.json while crawling",
+    )
+
     return parser.parse_args()
 
 
@@ -99,27 +164,60 @@ def main():
     logger.debug(f"[*] Date range: {start_date}~{end_date}")
     logger.debug(f"[*] Crawling targets: {', '.join(args.targets)}")
 
+    # instaloader requests are not cached
+    if args.offline and "instagram" in [target.lower() for target in args.targets]:
+        logger.info("[*] Instagram is skipped in offline mode")
+        args.targets = [t for t in args.targets if t.lower() != "instagram"]
+        if not args.targets:
+            return
+
+    if args.metrics_port is not None:
+        metrics.collector.serve(args.metrics_port)
+        logger.info(
+            f"[*] Serving metrics at http://localhost:{args.metrics_port}/metrics"
+        )
+
     logger.debug("[*] Running crawlers...")
 
-    pool = concurrent.futures.ThreadPoolExecutor()
+    # one crawler thread per query x target
+    max_workers = min(32, len(args.query) * len(args.targets))
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    # every crawler shares one pooled session, so that keep-alive connections
+    # are reused across queries. size the pool to the number of concurrent requests
+    max_in_flight = max(
+        config.NAVER_BLOG_MAX_IN_FLIGHT,
+        config.NAVER_CAFE_MAX_IN_FLIGHT,
+        config.TISTORY_MAX_IN_FLIGHT,
+    )
+    cache = None
+    if args.cache or args.offline:
+        cache = http_cache.create_cache(offline=args.offline)
+    session = http_pool.create_session(
+        pool_maxsize=max_workers * max_in_flight, cache=cache
+    )
+
+    # posts found by several queries are fetched once
+    post_registry = registry.PostRegistry()
+
     futures = []
     for q in args.query:
-        crawling_targets = [target2crawler[target.lower()]() for target in args.targets]
+        crawling_targets = [
+            target2crawler[target.lower()](session=session, registry=post_registry)
+            for target in args.targets
+        ]
         futures.extend(
             [
                 pool.submit(
-                    lambda query, start_date, end_date, analyse, main_columns_only: c.run(
-                        query=query,
-                        start_date=start_date,
-                        end_date=end_date,
-                        analyse=analyse,
-                        main_columns_only=main_columns_only,
-                    ),
-                    q,
-                    start_date,
-                    end_date,
-                    args.analyse,
-                    not args.all_columns,
+                    c.run,
+                    query=q,
+                    start_date=start_date,
+                    end_date=end_date,
+                    analyse=args.analyse,
+                    main_columns_only=not args.all_columns,
+                    save_format=args.format,
+                    incremental=args.incremental,
+                    fields=args.fields,
                 )
                 for c in crawling_targets
             ]
@@ -133,6 +231,11 @@ def main():
         pool._threads.clear()
         concurrent.futures.thread._threads_queues.clear()
         raise
+    finally:
+        # metrics of interrupted runs are saved as well
+        if args.metrics is not None:
+            metrics.collector.save(args.metrics)
+            logger.info(f"[*] Metrics saved to {args.metrics}")
 
     pool.shutdown()
 
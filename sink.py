@@ -0,0 +1,196 @@
+import gzip
+import json
+import logging
+import os
+import pathlib
+import store
+import columnar
+import loader
+import config
+
+# output format: file extension
+FORMATS = {
+    "jsonl": ".jsonl",
+    "jsonl.gz": ".jsonl.gz",
+    "json": ".json",
+    # every post of every run in one indexed database, see store.py
+    "sqlite": ".sqlite3",
+    # a directory of memory-mappable column arrays, see columnar.py
+    "columns": ".columns",
+}
+
+
+class JsonlSink:
+    """writes each post as one JSON line as soon as it is written,
+    so that partial results are kept on disk during long crawls"""
+
+    def __init__(self, path, compress=False, append=False):
+        self.path = path
+        mode = "a" if append else "w"
+        if compress:
+            # appending creates a new gzip member, which is still a valid gzip file
+            self._f = gzip.open(str(path), f"{mode}t", encoding="utf-8")
+        else:
+            self._f = open(str(path), mode, encoding="utf-8")
+
+    def write(self, post):
+        self._f.write(json.dumps(post, ensure_ascii=False))
+        self._f.write("\n")
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class JsonSink:
+    """writes posts as a pretty printed JSON array,
+    identical to `json.dumps(posts, indent=2)` but without holding every post in memory
+    """
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self._f = None
+        self._tmp = None
+
+        if not (append and path.exists()):
+            self._f = open(str(path), "w", encoding="utf-8")
+            self._empty = True
+            return
+
+        # JSON array can not be appended in place, existing posts are copied to a new file first,
+        # which replaces the existing one on close, so that an interrupted run does not corrupt it
+        self._tmp = path.with_name(f"{path.name}.tmp")
+        self._f = open(str(self._tmp), "w", encoding="utf-8")
+        self._empty = True
+        try:
+            for post in loader.iter_posts(path):
+                self.write(post)
+        except ValueError as e:
+            # unterminated array (e.g. saved by an interrupted run), complete posts are kept
+            logging.getLogger(config.LOGGER_NAME).info(
+                f"[*] Incomplete JSON array {str(path)}, kept posts read so far ({e})"
+            )
+
+    def write(self, post):
+        dump = json.dumps(post, indent=2, ensure_ascii=False)
+        dump = "\n".join(f"  {line}" for line in dump.split("\n"))
+        self._f.write("[\n" if self._empty else ",\n")
+        self._f.write(dump)
+        self._f.flush()
+        self._empty = False
+
+    def close(self):
+        self._f.write("[]" if self._empty else "\n]")
+        self._f.close()
+        if self._tmp is not None:
+            os.replace(str(self._tmp), str(self.path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _key(post, key_fields):
+    """key of `post` as stored in the post store (see store.py), None without key columns"""
+    if not key_fields or any(post.get(field) is None for field in key_fields):
+        return None
+    return "/".join(str(post[field]) for field in key_fields)
+
+
+def _saved_keys(path, key_fields):
+    """keys of posts saved at `path`"""
+    keys = set()
+    try:
+        for post in loader.iter_posts(path, fields=key_fields):
+            keys.add(_key(post, key_fields))
+    except ValueError as e:
+        # incomplete file (e.g. saved by an interrupted run), keys read so far are kept
+        logging.getLogger(config.LOGGER_NAME).info(
+            f"[*] Incomplete dataset {str(path)}, kept posts read so far ({e})"
+        )
+    keys.discard(None)
+    return keys
+
+
+class UniqueSink:
+    """writes to `sink` only posts whose key (see `key_fields`) is not in `keys`,
+    i.e. skips posts already saved by a previous run.
+
+    an interrupted incremental run keeps its posts but does not commit its high-water mark
+    (see watermark.py), so that the next run crawls and appends them again
+    """
+
+    def __init__(self, sink, key_fields, keys):
+        self._sink = sink
+        self.path = sink.path
+        self.key_fields = key_fields
+        self._keys = keys
+
+    def write(self, post):
+        key = _key(post, self.key_fields)
+        if key is not None:
+            if key in self._keys:
+                return
+            self._keys.add(key)
+        self._sink.write(post)
+
+    def close(self):
+        self._sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_sink(
+    save_dir, name, fmt="jsonl", append=False, platform=None, query=None, key_fields=()
+):
+    """open a sink writing to `<save_dir>/<name>.<ext>`,
+    if `append` is set, posts are added to the existing file instead of overwriting it
+
+    the sqlite format upserts posts of `platform` found by `query`
+    into the post store `<save_dir>/posts.sqlite3` instead (see store.py),
+    posts are identified by their `key_fields`.
+    other formats skip appended posts whose `key_fields` are already saved (see UniqueSink)
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown output format: {fmt}")
+
+    directory = pathlib.Path(save_dir)
+    directory.mkdir(parents=True, exist_ok=True)
+    if fmt == "sqlite":
+        return store.StoreSink(
+            directory / store.STORE_NAME,
+            platform,
+            query,
+            key_fields,
+            config.STORE_BATCH_SIZE,
+        )
+
+    path = directory / f"{name}{FORMATS[fmt]}"
+
+    # keys are read before the sink opens (and possibly rewrites) the dataset
+    keys = None
+    if append and key_fields and path.exists():
+        keys = _saved_keys(path, key_fields)
+
+    if fmt == "columns":
+        output = columnar.ColumnarSink(path, append=append)
+    elif fmt == "json":
+        output = JsonSink(path, append=append)
+    else:
+        output = JsonlSink(path, compress=fmt == "jsonl.gz", append=append)
+
+    if keys is None:
+        return output
+    return UniqueSink(output, key_fields, keys)
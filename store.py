@@ -0,0 +1,147 @@
+import json
+import pathlib
+import sqlite3
+
+# file name of the post store in the save directory
+STORE_NAME = "posts.sqlite3"
+
+_SCHEMA = (
+    # posts of every platform, keyed by (platform, post key), `data` is the post as JSON
+    """CREATE TABLE IF NOT EXISTS posts (
+        platform TEXT NOT NULL,
+        key TEXT NOT NULL,
+        created TEXT,
+        username TEXT,
+        data TEXT NOT NULL,
+        PRIMARY KEY (platform, key)
+    )""",
+    # queries each post was found by
+    """CREATE TABLE IF NOT EXISTS post_queries (
+        platform TEXT NOT NULL,
+        key TEXT NOT NULL,
+        query TEXT NOT NULL,
+        PRIMARY KEY (query, platform, key)
+    )""",
+    "CREATE INDEX IF NOT EXISTS posts_created ON posts (platform, created)",
+    "CREATE INDEX IF NOT EXISTS posts_username ON posts (username)",
+)
+
+
+def connect(path):
+    """connect to the post store at `path`, creating it if needed"""
+    db = sqlite3.connect(str(path), timeout=60)
+    # readers do not block the writer (and vice versa), crawler threads write concurrently
+    db.execute("PRAGMA journal_mode=WAL")
+    with db:
+        for statement in _SCHEMA:
+            db.execute(statement)
+    return db
+
+
+class StoreSink:
+    """upserts posts into the post store, keyed by (platform, post key).
+    a post is stored once however many queries / runs found it, with its latest data
+
+    `key_fields` are the columns identifying a post of the platform (see Crawler.KEY_FIELDS).
+    posts are committed `batch_size` at a time, the connection is used by one thread only.
+    """
+
+    def __init__(self, path, platform, query, key_fields, batch_size=100):
+        self.path = path
+        self.platform = platform
+        self.query = query
+        self.key_fields = key_fields
+        self.batch_size = batch_size
+        self._db = connect(path)
+        self._batch = []
+
+    def write(self, post):
+        key = "/".join(str(post[field]) for field in self.key_fields)
+        self._batch.append(
+            (
+                key,
+                post.get("created"),
+                post.get("username"),
+                json.dumps(post, ensure_ascii=False),
+            )
+        )
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._batch:
+            return
+
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO posts (platform, key, created, username, data) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(self.platform, *row) for row in self._batch],
+            )
+            self._db.executemany(
+                "INSERT OR IGNORE INTO post_queries (platform, key, query) VALUES (?, ?, ?)",
+                [(self.platform, row[0], self.query) for row in self._batch],
+            )
+        self._batch = []
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def select(
+    path,
+    platform=None,
+    query=None,
+    start_date=None,
+    end_date=None,
+    username=None,
+):
+    """yields stored posts matching every given condition, in created order.
+    e.g. select("save/posts.sqlite3", "Tistory", "thornapple", date(2020, 3, 1), date(2020, 3, 31))
+
+    `platform` is the crawler class name, dates are inclusive.
+    """
+    conditions = []
+    params = []
+    if platform is not None:
+        conditions.append("posts.platform = ?")
+        params.append(platform)
+    if query is not None:
+        # looked up from post_queries by query, then posts by primary key (no scan of posts)
+        conditions.append(
+            "(posts.platform, posts.key) IN "
+            "(SELECT platform, key FROM post_queries WHERE query = ?)"
+        )
+        params.append(query)
+    if start_date is not None:
+        conditions.append("posts.created >= ?")
+        params.append(start_date.isoformat())
+    if end_date is not None:
+        # created is an ISO datetime, every time of `end_date` sorts before the next day
+        conditions.append("posts.created < ?")
+        params.append(f"{end_date.isoformat()}~")
+    if username is not None:
+        conditions.append("posts.username = ?")
+        params.append(username)
+
+    sql = "SELECT data FROM posts"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY posts.created"
+
+    if not pathlib.Path(path).exists():
+        return
+
+    db = sqlite3.connect(str(path), timeout=60)
+    try:
+        for (data,) in db.execute(sql, params):
+            yield json.loads(data)
+    finally:
+        db.close()
@@ -1,18 +1,59 @@
 from datetime import datetime
-import json
-import pathlib
 import logging
 import re
-import time
-import requests
-from bs4 import BeautifulSoup
 import config
+import fetcher
+import pager
+import http_cache
+import http_pool
+import registry
+import extract
+import metrics
 from crawler import Crawler
+import sink
+import watermark
+
+# 티스토리 블로그 게시글에서 추출하는 항목별 XPath 목록 (앞의 XPath부터 찾은 값을 사용)
+#! WARNING: 실험적으로 찾아낸 값으로, 상황에 따라 업데이트 필요
+POST_SPEC = {
+    # 글 내용
+    "text": extract.by_class(
+        ("div",),
+        (
+            "tt_article_useless_p_margin",  # https://cow5jean.tistory.com/29
+            "article_view",  # https://milkbean.tistory.com/16?category=842530
+            "entry-content",  # https://simyeju.tistory.com/48
+            "post-content",  # https://philipbox.tistory.com/79
+            "desc",  # https://michaelchoi.tistory.com/25
+            "article_cont",  # https://iton.tistory.com/4090
+            "article",  # https://freepanda.tistory.com/47
+            "area_view",  # https://choish313.tistory.com/122
+        ),
+    ),
+}
+
+post_extractor = extract.Extractor(POST_SPEC)
 
 
 class Tistory(Crawler):
+    FIELDS = (
+        "title",
+        "blogname",
+        "postUrl",
+        "blogUrl",
+        "summary",
+        "thumbnailUrl",
+        "created",
+        "text",
+    )
+    MAIN_FIELDS = ("title", "created", "text")
+    # columns identifying a post, kept whenever posts are stored (see store.py)
+    KEY_FIELDS = ("postUrl",)
+
     def __init__(self, *args, **kwargs):
         self.app_key = kwargs["key"]
+        # maximum number of posts fetched at the same time
+        self.max_in_flight = kwargs.get("max_in_flight", 1)
         self._query = ""
         self._done = False
         self._data = None
@@ -20,53 +61,65 @@ class Tistory(Crawler):
             config.LOGGER_NAME
         )  # when packaged, change this to logger.getLogger(__name__)
         self._analyser = None
-        self._session = requests.session()
-
-        self._session.headers.update(
-            {
-                "Authorization": f"KakaoAK {self.app_key}",
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/79.0.3945.130 Safari/537.36",
-            }
-        )
+        # session may be shared with other crawlers,
+        # therefore headers are passed per request instead of set on the session
+        self._session = kwargs.get("session") or http_pool.create_session()
+        # registry may be shared with crawlers of other queries, not to parse a post twice
+        self._registry = kwargs.get("registry") or registry.PostRegistry()
+        self._headers = {
+            "Authorization": f"KakaoAK {self.app_key}",
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/79.0.3945.130 Safari/537.36",
+        }
 
     def _parse_post(self, url):
-        r = self._session.get(url=url)
-        soup = BeautifulSoup(r.text, "html.parser")
-        text = ""
+        with self._timer("fetch"):
+            r = self._session.get(url=url, headers=self._headers, cache="post")
 
-        # 1) text
+        with self._timer("parse", cpu=True):
+            found = post_extractor.extract(r.text)
+            text = ""
 
-        # 티스토리 블로그에서 글 내용에 사용되는 클래스 목록
-        #! WARNING: 실험적으로 찾아낸 값으로, 상황에 따라 업데이트 필요
-        text_class = (
-            "tt_article_useless_p_margin",  # https://cow5jean.tistory.com/29
-            "article_view",  # https://milkbean.tistory.com/16?category=842530
-            "entry-content",  # https://simyeju.tistory.com/48
-            "post-content",  # https://philipbox.tistory.com/79
-            "desc",  # https://michaelchoi.tistory.com/25
-            "article_cont",  # https://iton.tistory.com/4090
-            "article",  # https://freepanda.tistory.com/47
-            "area_view",  # https://choish313.tistory.com/122
-        )
-        found = False
-        for tag in soup.find_all("div"):
-            tag_class = tag.get("class", [])
-            for ccls in text_class:
-                if ccls in tag_class:
-                    text = tag.text.strip()
-                    text = re.sub(r"\s+", " ", text)  # compress whitespaces
-                    found = True
-                    break
-            if found:
-                break
-        else:  # not found
-            self._log(f"NOT FOUND: text ({url})", False)
+            # 1) text
+            if found["text"] is not None:
+                text = re.sub(r"\s+", " ", found["text"])  # compress whitespaces
+            else:  # not found
+                self._log(f"NOT FOUND: text ({url})", False)
 
         return {
             "text": text,
         }
 
-    def crawl(self, query, start_date, end_date, main_columns_only, full=True):
+    def _next_search_params(self, r, params, start_date):
+        """params of the search page following `r`, None if there is no need to fetch more"""
+        if not r.ok:
+            return None
+
+        resp = r.json()
+
+        # results are sorted by date, stop prefetching once `start_date` is reached
+        if any(
+            datetime.strptime(document["datetime"], "%Y-%m-%dT%H:%M:%S.000%z").date()
+            < start_date
+            for document in resp["documents"]
+        ):
+            return None
+
+        if resp["meta"]["is_end"]:
+            self._log("No more item, stop crawling...")
+            return None
+
+        return {**params, "page": params["page"] + 1}
+
+    def iter_crawl(
+        self,
+        query,
+        start_date,
+        end_date,
+        main_columns_only,
+        full=True,
+        mark=None,
+        fields=None,
+    ):
         url = "https://dapi.kakao.com/v2/search/blog"
         display_size = 50
         params = {
@@ -77,81 +130,127 @@ class Tistory(Crawler):
         }
 
         self._query = query
-        posts = []
+        fields = self._fields(main_columns_only, fields)
+        # post pages are fetched only for the text
+        full = full and "text" in fields
+
+        def search(params):
+            with self._timer("search"):
+                try:
+                    return self._session.get(
+                        url=url, params=params, headers=self._headers, cache="search"
+                    )
+                except http_cache.CacheMiss as e:
+                    # offline mode, the page was not requested by previous runs
+                    self._log(f"{e}, stop crawling...", False)
+                    return None
+
         stop = False
         cur_date = None
+        pages = pager.Pager(
+            search,
+            params,
+            lambda r, params: self._next_search_params(r, params, start_date),
+            prefetch=config.SEARCH_PREFETCH_PAGES,
+        )
+        with pages:
+            for r in pages:
+                if r is None or not r.ok:
+                    # older posts in range are not crawled
+                    if mark is not None:
+                        mark.fail()
+                    if r is None:
+                        return
+                    if r.status_code == 401:
+                        self._log("ERROR: KAKAO API 키를 설정하세요", False)
+                        return
+                    else:  # Undefined status codes
+                        self._log(f"FAILED ({r.status_code}/{r.text})", False)
+                        return
 
-        while True:
-            r = self._session.get(url=url, params=params)
-            if not r.ok:
-                if r.status_code == 401:
-                    self._log("ERROR: KAKAO API 키를 설정하세요", False)
-                    return posts
-                else:  # Undefined status codes
-                    self._log(f"FAILED ({r.status_code}/{r.text})", False)
-                    return posts
-
-            resp = r.json()
-            for document in resp["documents"]:
-                # if not tistory, skip
-                if "tistory.com" not in document["url"]:
-                    continue
-
-                postdate = datetime.strptime(
-                    document["datetime"], "%Y-%m-%dT%H:%M:%S.000%z"
-                )
-                if postdate.date() < start_date or postdate.date() > end_date:
-                    self._log("Post out of range, stop crawling...")
-                    stop = True
-                    break
+                resp = r.json()
+                page = []
+                for document in resp["documents"]:
+                    # if not tistory, skip
+                    if "tistory.com" not in document["url"]:
+                        continue
+
+                    postdate = datetime.strptime(
+                        document["datetime"], "%Y-%m-%dT%H:%M:%S.000%z"
+                    )
+                    if postdate.date() < start_date or postdate.date() > end_date:
+                        self._log("Post out of range, stop crawling...")
+                        stop = True
+                        break
+
+                    # already collected by the previous (incremental) run
+                    if mark is not None:
+                        if mark.passed(postdate.isoformat()):
+                            self._log("Reached collected posts, stop crawling...")
+                            stop = True
+                            break
+                        if mark.seen(postdate.isoformat(), document["url"]):
+                            continue
+                        mark.update(postdate.isoformat(), document["url"])
+
+                    # Date logging (for progress checking)
+                    if postdate != cur_date:
+                        cur_date = postdate.date()
+                        self._log(f"crawling on date={cur_date}")
 
-                # Date logging (for progress checking)
-                if postdate != cur_date:
-                    cur_date = postdate.date()
-                    self._log(f"crawling on date={cur_date}")
-
-                post_data = {
-                    "title": document["title"],
-                    "blogname": document["blogname"],
-                    "postUrl": document["url"],
-                    "blogUrl": document["url"][
-                        : document["url"].rindex("/")
-                    ],  # strip rightmost slash
-                    "summary": document["contents"],
-                    "thumbnailUrl": document["thumbnail"],
-                    "created": postdate.isoformat(),
-                }
+                    post_data = {
+                        "title": document["title"],
+                        "blogname": document["blogname"],
+                        "postUrl": document["url"],
+                        "blogUrl": document["url"][
+                            : document["url"].rindex("/")
+                        ],  # strip rightmost slash
+                        "summary": document["contents"],
+                        "thumbnailUrl": document["thumbnail"],
+                        "created": postdate.isoformat(),
+                    }
+                    page.append(post_data)
 
                 # kakao search api does not reveal full blog data,
                 # therefore, manual crawling needed to get full data.
                 # however, this might be considered as an malicious behavior.
                 if full:
-                    try:
-                        post_full = self._parse_post(document["url"])
-                        post_data.update(post_full)
-                        time.sleep(config.REQUEST_INTERVAL)  # prevent massive request
-                    except Exception as e:
-                        self._log(f"Parsing blog failed {document['url']}", False)
-                        self._log(e)
+                    posts_full = fetcher.gather(
+                        self._registry.fetch,
+                        [
+                            (("tistory", p["postUrl"]), self._parse_post, p["postUrl"])
+                            for p in page
+                        ],
+                        self.max_in_flight,
+                    )
+                    for post_data, post_full in zip(page, posts_full):
+                        if isinstance(post_full, Exception):
+                            metrics.inc(
+                                "errors_total",
+                                platform=self.__class__.__name__,
+                                stage="fetch",
+                            )
+                            self._log(
+                                f"Parsing blog failed {post_data['postUrl']}", False
+                            )
+                            self._log(post_full)
+                        else:
+                            post_data.update(post_full)
 
-                if main_columns_only:
-                    del post_data["blogname"]
-                    del post_data["blogUrl"]
-                    del post_data["postUrl"]
-                    del post_data["summary"]
-                    del post_data["thumbnailUrl"]
+                for post_data in page:
+                    yield {k: v for k, v in post_data.items() if k in fields}
 
-                posts.append(post_data)
-
-            if stop:
-                break
-
-            if resp["meta"]["is_end"]:
-                self._log("No more item, stop crawling...")
-                break
-
-            params["page"] += 1
+                if stop:
+                    break
 
+    def crawl(
+        self, query, start_date, end_date, main_columns_only, full=True, fields=None
+    ):
+        posts = list(
+            self.iter_crawl(
+                query, start_date, end_date, main_columns_only, full, fields=fields
+            )
+        )
         self._done = True
         self._data = posts
         return posts
@@ -165,20 +264,59 @@ class Tistory(Crawler):
         analyse=True,
         save_dir="save",
         main_columns_only=True,
+        save_format="jsonl",
+        incremental=False,
+        fields=None,
     ):
-        posts = self.crawl(query, start_date, end_date, main_columns_only)
+        name = f"{self.__class__.__name__}_{query}_{start_date}~{end_date}"
+        mark = None
+        if incremental:
+            # crawl only posts newer than the previous run,
+            # and merge them into one dataset per query
+            watermarks = watermark.load(save_dir)
+            mark = watermarks.mark(self.__class__.__name__, query)
+            name = f"{self.__class__.__name__}_{query}"
+
+        # posts are stored by their key columns, and indexed by date.
+        # appended posts are identified by their key columns as well (see sink.open_sink)
+        if save and (save_format == "sqlite" or incremental):
+            fields = self._fields(main_columns_only, fields).union(
+                self.KEY_FIELDS, ("created",)
+            )
+
+        posts = self.iter_crawl(
+            query, start_date, end_date, main_columns_only, mark=mark, fields=fields
+        )
+
+        # posts are written one by one as soon as they are crawled,
+        # so that memory stays flat and partial results are kept on disk
+        output = None
         if save:
-            dump = json.dumps(posts, indent=2, ensure_ascii=False)
-            directory = pathlib.Path(save_dir)
-            directory.mkdir(parents=True, exist_ok=True)
-            f = (
-                directory
-                / f"{self.__class__.__name__}_{query}_{start_date}~{end_date}.json"
+            output = sink.open_sink(
+                save_dir,
+                name,
+                save_format,
+                append=incremental,
+                platform=self.__class__.__name__,
+                query=query,
+                key_fields=self.KEY_FIELDS,
             )
+            self._log(f"Saving results to {str(output.path)}", False)
+
+        try:
+            for post in posts:
+                metrics.inc("posts_total", platform=self.__class__.__name__)
+                if output is not None:
+                    with self._timer("save"):
+                        output.write(post)
+        finally:
+            if output is not None:
+                output.close()
 
-            self._log(f"Saving results to {str(f)}", False)
-            with open(str(f), "w", encoding="utf-8") as f:
-                f.write(dump)
+        if incremental:
+            if not mark.complete:
+                self._log("Crawl incomplete, high-water mark not updated", False)
+            watermarks.commit(self.__class__.__name__, query, mark)
 
         # TODO
         # if analyse:
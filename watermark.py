@@ -0,0 +1,89 @@
+import json
+import os
+import pathlib
+import threading
+
+_lock = threading.Lock()
+_stores = {}
+
+
+class Mark:
+    """high-water mark of a (target, query): the newest post collected by the previous run,
+    and the newest post seen by the current run"""
+
+    def __init__(self, state=None):
+        state = state or {}
+        self._created = state.get("created")
+        self._ids = set(state.get("ids", []))
+
+        self.created = self._created
+        self.ids = set(self._ids)
+        # false when the current run missed posts, see fail
+        self.complete = True
+
+    def passed(self, created):
+        """whether a post created at `created` is older than the previous run's newest post,
+        i.e. every following post (in date desc order) was already collected"""
+        return self._created is not None and created < self._created
+
+    def seen(self, created, post_id):
+        """whether the post was already collected by the previous run"""
+        return created == self._created and post_id in self._ids
+
+    def update(self, created, post_id):
+        if self.created is None or created > self.created:
+            self.created = created
+            self.ids = {post_id}
+        elif created == self.created:
+            self.ids.add(post_id)
+
+    def fail(self):
+        """the current run stopped before collecting every post in range (e.g. a search page
+        failed), the mark is not committed so that the next run crawls those posts again
+        """
+        self.complete = False
+
+    def state(self):
+        return {"created": self.created, "ids": sorted(self.ids, key=str)}
+
+
+class Watermarks:
+    """high-water marks per (target, query), persisted as a JSON file"""
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self._lock = threading.Lock()
+        self._marks = {}
+        if self.path.exists():
+            with open(str(self.path), "r", encoding="utf-8") as f:
+                self._marks = json.loads(f.read())
+
+    def mark(self, target, query):
+        with self._lock:
+            return Mark(self._marks.get(target, {}).get(query))
+
+    def commit(self, target, query, mark):
+        """store `mark` as the high-water mark of (target, query),
+        unless the run missed posts (see Mark.fail)"""
+        if mark.created is None or not mark.complete:
+            return
+
+        with self._lock:
+            self._marks.setdefault(target, {})[query] = mark.state()
+
+            # write to a temporary file first, not to corrupt marks on crash
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(self.path.name + ".tmp")
+            with open(str(tmp), "w", encoding="utf-8") as f:
+                f.write(json.dumps(self._marks, indent=2, ensure_ascii=False))
+            os.replace(str(tmp), str(self.path))
+
+
+def load(save_dir):
+    """high-water marks stored in `save_dir`, shared by every crawler in the process"""
+    path = pathlib.Path(save_dir) / ".watermarks.json"
+    with _lock:
+        key = str(path.resolve())
+        if key not in _stores:
+            _stores[key] = Watermarks(path)
+        return _stores[key]